@@ -59,6 +59,52 @@ class Page(object):
 
     __repr__ = __str__
 
+# 定义CursorPage类存储游标(键集)分页信息
+class CursorPage(object):
+    '''
+    Cursor page object for keyset pagination, which avoids scanning skipped rows.
+    '''
+
+    def __init__(self, page_size=10, cursor=None):
+        '''
+        Init Pagination by page_size and the opaque cursor of the previous page.
+        >>> p1 = CursorPage(10)
+        >>> p1.limit
+        11
+        >>> p1.has_previous
+        False
+        >>> p1.paginate([])
+        []
+        >>> p1.has_next
+        False
+        >>> p1.next_cursor is None
+        True
+        '''
+        self.page_size = page_size
+        self.cursor = cursor
+        # 多取一条记录用于判断是否还有下一页
+        self.limit = page_size + 1
+        self.item_count = 0
+        self.next_cursor = None
+        self.has_next = False
+        self.has_previous = cursor is not None
+
+    def paginate(self, items):
+        '''
+        Trim the extra row fetched by limit and compute next_cursor.
+        '''
+        self.has_next = len(items) > self.page_size
+        items = items[:self.page_size]
+        self.item_count = len(items)
+        if self.has_next:
+            self.next_cursor = items[-1].getCursor()
+        return items
+
+    def __str__(self):
+        return 'item_count: %s, page_size: %s, cursor: %s, next_cursor: %s' % (self.item_count, self.page_size, self.cursor, self.next_cursor)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
     the base APIError which contains error(required), data(optional) and message(optional).
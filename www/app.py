@@ -9,7 +9,7 @@ async web application.
 
 import logging; logging.basicConfig(level=logging.INFO)
 
-import asyncio, os ,json, time
+import asyncio, os ,json, time, signal
 from datetime import datetime
 
 from aiohttp import web
@@ -21,6 +21,8 @@ import orm
 from coroweb import add_routes, add_static
 
 from handlers import cookie2user, COOKIE_NAME
+from models import User, Blog, Comment, set_id_generator, comment_counts, enable_comment_queue, close_comment_queue
+from search import init_search, close_search
 
 # 初始化前端模板引擎jinja2
 def init_jinja2(app, **kw):
@@ -66,6 +68,32 @@ async def logger_factory(app, handler):
         return (await handler(request))
     return logger
 
+# 编写限制请求中数据库操作总耗时的middleware，超时的语句被中止，返回503
+async def deadline_factory(app, handler):
+    async def deadline(request):
+        if not configs.db.request_timeout:
+            return (await handler(request))
+        try:
+            with orm.deadline(configs.db.request_timeout):
+                return (await handler(request))
+        except asyncio.TimeoutError:
+            logging.warning('database deadline exceeded: %s %s' % (request.method, request.path))
+            return web.Response(status=503, text='Service Unavailable')
+    return deadline
+
+# 编写统计请求中数据库语句的middleware，在响应头中输出语句数及数据库耗时(毫秒)；
+# 超过语句预算或同一语句重复过多时记录警告，debug模式下直接报错
+async def query_stats_factory(app, handler):
+    async def query_stats(request):
+        budget = configs.db.query_budget or {}
+        with orm.track_queries('%s %s' % (request.method, request.path), strict=configs.debug, **budget) as stats:
+            r = await handler(request)
+        if isinstance(r, web.StreamResponse) and not r.prepared:
+            r.headers['X-Query-Count'] = str(stats.count)
+            r.headers['X-DB-Time'] = '%.1f' % (stats.time * 1000)
+        return r
+    return query_stats
+
 # 编写将登录用户绑定到request对象上的middleware，后续的URL处理函数可以直接拿到登录用户
 async def auth_factory(app, handler):
     async def auth(request):
@@ -132,8 +160,8 @@ async def response_factory(app, handler):
             if template is None:
                 # ensure_ascii：默认True，仅能输出ascii格式数据，故设置为False
 				# default：r对象会先被传入default中的函数进行处理，然后才被序列化为json对象
-				# __dict__：以dict形式返回对象属性和值的映射
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+				# __dict__：以dict形式返回对象属性和值的映射，紧凑行对象(orm.Row)没有__dict__，调用to_dict()
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.to_dict() if isinstance(o, orm.Row) else o.__dict__).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             # 若带模板信息，渲染模板
@@ -194,8 +222,22 @@ def datetime_filter(t):
 # 版本二
 if __name__ == '__main__':
     async def init(loop):
-        await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='www-data', password='www-data', db='awesome')
-        app = web.Application(loop = loop, middlewares=[logger_factory, auth_factory, data_factory, response_factory])
+        set_id_generator(**configs.id)
+        await orm.create_pool(loop=loop, backend=configs.db.backend, host=configs.db.host, port=configs.db.port, user=configs.db.user, password=configs.db.password, db=configs.db.db, replicas=configs.db.replicas, timeout=configs.db.timeout, **configs.db.pool)
+        if configs.db.backend == 'sqlite':
+            # SQLite数据库在启动时按Model建表
+            await orm.create_tables(User, Blog, Comment)
+        if configs.db.query_cache:
+            orm.enable_query_cache(**configs.db.query_cache)
+        if configs.db.count_cache:
+            orm.enable_count_cache(**configs.db.count_cache)
+        if configs.db.slow_query:
+            orm.enable_slow_query_log(**configs.db.slow_query)
+        await init_search(**configs.search)
+        comment_counts.start(**configs.counters)
+        if configs.comment_queue:
+            await enable_comment_queue(**configs.comment_queue)
+        app = web.Application(loop = loop, middlewares=[logger_factory, query_stats_factory, deadline_factory, auth_factory, data_factory, response_factory])
         init_jinja2(app, filters=dict(datetime = datetime_filter))
         add_routes(app, 'handlers')
         add_static(app)
@@ -205,4 +247,13 @@ if __name__ == '__main__':
  
     loop = asyncio.get_event_loop()
     loop.run_until_complete(init(loop))
-    loop.run_forever()
\ No newline at end of file
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        # 退出前写入队列中的评论及缓冲的评论数，保存搜索索引的快照
+        try:
+            loop.run_until_complete(close_comment_queue())
+            loop.run_until_complete(comment_counts.flush())
+        finally:
+            close_search()
\ No newline at end of file
@@ -10,11 +10,57 @@ __author__ = 'ZcJ'
 configs = {
     'debug': True,
     'db': {
+        # 数据库后端：mysql或sqlite，使用sqlite时db为数据库文件路径
+        'backend': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        # 连接池：启动时预先打开warmup个连接；连接数上限从limit起按获取连接的等待时间自适应，最多maxsize；
+        # 打开超过max_lifetime秒的连接关闭重建
+        'pool': {
+            'minsize': 1,
+            'maxsize': 30,
+            'limit': 10,
+            'warmup': 5,
+            'max_lifetime': 3600
+        },
+        # 单条语句的超时秒数及一个请求中数据库操作的总超时秒数，超时的语句被中止(MySQL执行KILL QUERY)，为None时不限制
+        'timeout': None,
+        'request_timeout': None,
+        # 每个请求的语句预算：超过budget条语句，或同一语句重复超过repeat次时记录警告(debug模式下报错)
+        'query_budget': {
+            'budget': 20,
+            'repeat': 5
+        },
+        # 只读副本，如：[{'host': '10.0.0.2'}]，未指定的参数沿用主库配置
+        'replicas': [],
+        # 查询结果缓存，如：{'maxsize': 1024, 'ttl': 60}，为None时关闭
+        'query_cache': None,
+        # 行数缓存，如：{'reconcile': 300, 'approximate_threshold': 1000000}，为None时关闭
+        'count_cache': None,
+        # 慢查询日志，如：{'threshold': 0.5, 'interval': 60}，为None时关闭
+        'slow_query': None
+    },
+    # 主键ID生成器：snowflake为19位的时间有序ID，worker(0~1023)在多进程部署时须各不相同；
+    # legacy为旧的50位ID。两种ID可以共存于同一列(varchar(50))，已有数据无需迁移
+    'id': {
+        'generator': 'snowflake',
+        'worker': 0
+    },
+    # 评论数：增量每interval秒批量写入，每reconcile秒按comments表校正一次
+    'counters': {
+        'interval': 1,
+        'reconcile': 3600
+    },
+    # 评论的后写队列，如：{'interval': 0.05, 'batch': 500, 'maxsize': 10000, 'spill': 'comments.spill'}，
+    # 评论每interval秒或积累batch条时批量写入，spill为崩溃后用于重放的本地文件；为None时关闭，评论同步写入
+    'comment_queue': None,
+    # 全文搜索：snapshot为索引快照的文件路径，索引修改后interval秒内保存，退出时保存，启动时加载；为None时启动时从blogs表重建
+    'search': {
+        'snapshot': None,
+        'interval': 1
     },
     'session': {
         'secret': 'Awesome'
@@ -12,9 +12,11 @@ import markdown2
 from aiohttp import web
 
 from coroweb import get, post
-from apis import Page, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
+from apis import Page, CursorPage, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
 
-from models import User, Comment, Blog, next_id
+from orm import transaction, gather
+from models import User, Comment, Blog, next_id, comment_counts, get_comment_queue
+from search import get_index, index_blog, remove_blog
 from config import configs
 
 COOKIE_NAME = 'awesession'
@@ -36,6 +38,15 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# 按游标分页查询，after为空字符串时返回第一页
+async def find_cursor_page(model, after, **kw):
+    p = CursorPage(cursor=after or None)
+    try:
+        items = await model.findAll(after=p.cursor, limit=p.limit, **kw)
+    except ValueError:
+        raise APIValueError('after', 'Invalid cursor.')
+    return p, p.paginate(items)
+
 # HTML转义字符
 async def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
@@ -82,13 +93,7 @@ async def cookie2user(cookie_str):
 # 首页
 @get('/')
 async def index(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    page = Page(num, page_index)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+    page, blogs = await Blog.findPage(orderBy='created_at desc', page_index=get_page_index(page), approximate=True, defer=True)
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -98,8 +103,7 @@ async def index(*, page='1'):
 # 日志详情页面
 @get('/blog/{id}')
 async def get_blog(id):
-    blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    blog, comments = await gather(Blog.find(id), Comment.findAll('blog_id=?', [id], orderBy='created_at desc'))
     for c in comments:
         c.html_content = markdown2.markdown(await text2html(c.content))
     blog.html_content = markdown2.markdown(blog.content)
@@ -207,13 +211,11 @@ async def manage_users(*, page='1'):
 
 # 获取评论API
 @get('/api/comments')
-async def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_comments(*, page='1', after=None):
+    if after is not None:
+        p, comments = await find_cursor_page(Comment, after, compact=True)
+        return dict(page=p, comments=comments)
+    p, comments = await Comment.findPage(orderBy='created_at desc', page_index=get_page_index(page), approximate=True, compact=True)
     return dict(page=p, comments=comments)
 
 # 创建评论API
@@ -228,7 +230,14 @@ async def api_create_comment(id, request, *, content):
     if blog is None:
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
-    await comment.save()
+    # 开启后写队列时评论稍后批量写入，立即返回(已生成id)
+    # 评论数在评论写入后增加，使用队列时由队列增加
+    queue = get_comment_queue()
+    if queue is None:
+        await comment.save()
+        comment_counts.add(blog.id, 1)
+    else:
+        await queue.put(comment)
     return comment
 
 # 删除评论API
@@ -239,17 +248,18 @@ async def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    comment_counts.add(c.blog_id, -1)
     return dict(id=id)
 
 # 获取用户API
 @get('/api/users')
-async def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_get_users(*, page='1', after=None):
+    if after is not None:
+        p, users = await find_cursor_page(User, after, compact=True)
+        for u in users:
+            u.passwd = '******'
+        return dict(page=p, users=users)
+    p, users = await User.findPage(orderBy='created_at desc', page_index=get_page_index(page), approximate=True, compact=True)
     for u in users:
         u.passwd = '******'
     return dict(page=p, users=users)
@@ -283,13 +293,11 @@ async def api_register_user(*, email, name, passwd):
 
 # 获取日志列表API
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_blogs(*, page='1', after=None):
+    if after is not None:
+        p, blogs = await find_cursor_page(Blog, after, defer=True, compact=True)
+        return dict(page=p, blogs=blogs)
+    p, blogs = await Blog.findPage(orderBy='created_at desc', page_index=get_page_index(page), approximate=True, defer=True, compact=True)
     return dict(page=p, blogs=blogs)
 
 # 获取日志详情API
@@ -310,6 +318,7 @@ async def api_create_blog(request, *, name, summary, content):
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     await blog.save()
+    index_blog(blog)
     return blog
 
 # 修改日志API
@@ -327,6 +336,7 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.summary = summary.strip()
     blog.content = content.strip()
     await blog.update()
+    index_blog(blog)
     return blog
 
 # 删除日志API
@@ -334,5 +344,25 @@ async def api_update_blog(id, request, *, name, summary, content):
 async def api_delete_blog(request, *, id):
     await check_admin(request)
     blog = await Blog.find(id)
-    await blog.remove()
-    return dict(id=id)
\ No newline at end of file
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    # 在同一个事务中删除日志及其评论
+    async with transaction():
+        await blog.remove()
+        await Comment.remove_many(await Comment.findAll('blog_id=?', [id], fields=[]))
+    remove_blog(id)
+    return dict(id=id)
+
+# 搜索日志API，按相关度排序
+@get('/api/search')
+async def api_search(*, q='', page='1'):
+    page_index = get_page_index(page)
+    index = get_index()
+    if index is None or not q.strip():
+        return dict(page=Page(0, page_index), blogs=())
+    num, hits = index.search(q, limit=10, offset=(page_index - 1) * 10)
+    p = Page(num, page_index)
+    if p.limit == 0:
+        return dict(page=p, blogs=())
+    blogs = await Blog.find_many([id for id, score in hits], fields=['user_id', 'user_name', 'user_image', 'name', 'summary', 'created_at'])
+    return dict(page=p, blogs=[b for b in blogs if b is not None])
\ No newline at end of file
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Diff models against the live database schema and emit DDL.
+
+    python3 migrate.py           # 打印需要执行的DDL
+    python3 migrate.py --apply   # 打印并执行
+    python3 migrate.py --apply --user root --password xxx
+
+执行DDL需要alter、create、index权限，schema.sql中授予应用账号(configs.db.user)的只有
+select、insert、update、delete，--apply时需用--user/--password指定有DDL权限的账号。
+'''
+
+__author__ = 'ZcJ'
+
+import logging; logging.basicConfig(level=logging.WARNING)
+
+import asyncio, argparse
+
+import orm
+from models import User, Blog, Comment
+from config import configs
+
+MODELS = (User, Blog, Comment)
+
+# 比较Model与数据库中的表结构，返回DDL列表，以'--'开头的为需要人工确认的提示
+def diff_schema(backend, schema, models):
+    L = []
+    for model in models:
+        table = schema.get(model.__table__, None)
+        if table is None:
+            L.append(backend.create_table_sql(model))
+            if not backend.inline_indexes:
+                L.extend(backend.create_index_sql(model, index) for index in model.__indexes__)
+            continue
+        # 缺少的列，类型不同的列只提示不修改(如schema.sql中content为mediumtext)
+        for f in [model.__primary_key__] + model.__fields__:
+            columnType = table['columns'].get(f, None)
+            if columnType is None:
+                L.append(backend.add_column_sql(model, f))
+            elif backend.normalize_type(columnType) != backend.normalize_type(model.__mappings__[f].column_type):
+                L.append('-- column type differs: %s.%s is %s, model declares %s' % (model.__table__, f, columnType, model.__mappings__[f].column_type))
+        # 缺少的索引，列相同的索引视为已存在；同名但列不同的索引重建
+        existing = {v: k for k, v in table['indexes'].items()}
+        declared = set()
+        for index in model.__indexes__:
+            name = backend.index_name(model, index)
+            declared.add(name)
+            spec = (index.unique, index.key_columns)
+            if spec in existing:
+                declared.add(existing[spec])
+                continue
+            if name in table['indexes']:
+                L.append(backend.drop_index_sql(model, name))
+            L.append(backend.create_index_sql(model, index))
+        for name in table['indexes']:
+            if name not in declared:
+                L.append('-- index not declared in model: %s.%s (%s)' % (model.__table__, name, ', '.join(table['indexes'][name][1])))
+    return L
+
+# user、password为连接数据库的账号，为None时使用configs.db中的应用账号
+async def migrate(loop, apply=False, user=None, password=None):
+    db = configs.db
+    await orm.create_pool(loop=loop, backend=db.backend, host=db.host, port=db.port, user=user or db.user, password=db.password if password is None else password, db=db.db, maxsize=1)
+    backend = orm.get_backend()
+    L = diff_schema(backend, await backend.get_schema(), MODELS)
+    if not L:
+        print('-- schema is up to date.')
+    for sql in L:
+        print(sql if sql.startswith('--') else '%s;' % sql)
+        if apply and not sql.startswith('--'):
+            await orm.execute(sql, [])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Diff models against the database schema and emit DDL.')
+    parser.add_argument('--apply', action='store_true', help='execute the emitted DDL')
+    parser.add_argument('--user', help='database user with DDL privileges (default: configs.db.user)')
+    parser.add_argument('--password', help='password of --user (default: configs.db.password)')
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(loop, args.apply, args.user, args.password))
@@ -8,17 +8,69 @@ Models for user, blog, comment.
 __author__ = 'ZcJ'
 
 import time, uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField, IdField, Index, CounterBuffer, WriteBehindQueue
+
+# 旧的ID：15位毫秒时间戳+32位uuid4+000，共50个字符
+def legacy_id():
+    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+
+# 定义Snowflake风格的64位ID生成器：41位毫秒时间戳(自epoch起) | 10位worker | 12位序列号
+# 返回补零的19位十进制字符串，字符串顺序与生成顺序一致，且排在所有旧ID之后，
+# 插入总是追加在主键索引的末尾；多进程部署时每个进程须使用不同的worker
+class SnowflakeId(object):
+
+    EPOCH = 1577836800000  # 2020-01-01 00:00:00 UTC，毫秒
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, worker=0):
+        if worker < 0 or worker >= 1 << self.WORKER_BITS:
+            raise ValueError('Invalid worker: %s' % worker)
+        self.worker = worker
+        self._last = 0
+        self._sequence = 0
+
+    def __call__(self):
+        ms = int(time.time() * 1000) - self.EPOCH
+        if ms > self._last:
+            self._last = ms
+            self._sequence = 0
+        else:
+            # 同一毫秒内或时钟回拨时沿用上次的时间戳，序列号用完后借用下一毫秒
+            self._sequence = (self._sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+            if self._sequence == 0:
+                self._last = self._last + 1
+        return '%019d' % ((self._last << (self.WORKER_BITS + self.SEQUENCE_BITS)) | (self.worker << self.SEQUENCE_BITS) | self._sequence)
+
+    # 从ID中解析出生成时间(秒)
+    @classmethod
+    def timestamp(cls, id):
+        return ((int(id) >> (cls.WORKER_BITS + cls.SEQUENCE_BITS)) + cls.EPOCH) / 1000
+
+_id_generator = SnowflakeId()
+
+# 设置ID生成器：'snowflake'(默认)或'legacy'，也可以传入返回字符串的函数
+def set_id_generator(generator='snowflake', **kw):
+    global _id_generator
+    if generator == 'snowflake':
+        _id_generator = SnowflakeId(**kw)
+    elif generator == 'legacy':
+        _id_generator = legacy_id
+    elif callable(generator):
+        _id_generator = generator
+    else:
+        raise ValueError('Invalid id generator: %s' % generator)
 
 # 生成唯一标识ID
 def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
+    return _id_generator()
 
 # 定义users表对应的User类
 class User(Model):
     __table__ = 'users'
+    __batch_find__ = True  # 每个请求都会通过cookie查找用户
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
     email = StringField(ddl='varchar(50)')
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
@@ -26,27 +78,57 @@ class User(Model):
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(default=time.time)
 
+    idx_email = Index('email', unique=True)  # 登录时按email查找
+    idx_created_at = Index('created_at')  # 按创建时间倒序分页
+
 # 定义blogs表对应的Blog类
 class Blog(Model):
     __table__ = 'blogs'
+    __batch_find__ = True
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    user_id = IdField()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    comment_count = IntegerField()  # 评论数，由comment_counts维护
     created_at = FloatField(default=time.time)
 
+    idx_created_at = Index('created_at')
+
 # 定义comments表对应的Comment类
 class Comment(Model):
     __table__ = 'comments'
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    blog_id = IdField()
+    user_id = IdField()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
\ No newline at end of file
+    created_at = FloatField(default=time.time)
+
+    idx_created_at = Index('created_at')
+    idx_blog_id_created_at = Index('blog_id', 'created_at')  # 日志详情页按blog_id查找评论并按时间排序
+
+# 日志的评论数：创建、删除评论时缓冲增量，定期批量写入并按comments表校正
+comment_counts = CounterBuffer(Blog, 'comment_count', Comment, 'blog_id')
+
+__comment_queue = None
+
+# 开启评论的后写队列，参数见orm.WriteBehindQueue；评论写入数据库后才增加日志的评论数
+async def enable_comment_queue(**kw):
+    global __comment_queue
+    __comment_queue = await WriteBehindQueue(Comment, counters=[comment_counts], **kw).start()
+    return __comment_queue
+
+# 退出前写入队列中的评论
+async def close_comment_queue():
+    if __comment_queue is not None:
+        await __comment_queue.close()
+
+# 获取评论的后写队列，未开启时返回None
+def get_comment_queue():
+    return __comment_queue
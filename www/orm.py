@@ -3,62 +3,1298 @@
 
 __author__ = 'ZcJ'
 
-import asyncio, logging
-import aiomysql
+import asyncio, logging, json, base64, itertools, contextvars, contextlib, collections, re, time, bisect, sqlite3, os, concurrent.futures
+
+from apis import Page
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None  # 只使用SQLite后端时可以不安装aiomysql
+
+__backend = None  # 数据库后端
+__pool = None  # 主库的连接池
+__replicas = []  # 只读副本的连接池
+__replica_cycle = None  # 轮询副本的迭代器
+# 当前请求(上下文)执行过写操作后，读操作改走主库，保证读到自己的写入
+_read_your_writes = contextvars.ContextVar('read_your_writes', default=False)
+# 当前上下文中进行的事务
+_transaction = contextvars.ContextVar('transaction', default=None)
+# 当前上下文(请求)的语句统计
+_query_stats = contextvars.ContextVar('query_stats', default=None)
+# 当前上下文中固定使用的连接
+_pinned = contextvars.ContextVar('pinned', default=None)
+# 当前上下文(请求)中数据库操作的截止时间(time.monotonic())
+_deadline = contextvars.ContextVar('deadline', default=None)
+__timeout = None  # 默认的单条语句超时秒数
 
 # 打印SQL语句，使用args防止SQL注入
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
 
-# 创建连接池
-async def create_pool(loop, **kw):
+# 定义数据库后端的基类，封装不同数据库在连接池、占位符、游标及DDL上的差异
+class Backend(object):
+
+    name = None
+    # 估算表行数的SQL，不支持时为None
+    approximate_rows_sql = None
+    # 查看执行计划的语句前缀
+    explain_prefix = 'explain '
+    # 主键重复时忽略该行的INSERT语句前缀
+    insert_ignore = 'insert ignore'
+    # 是否支持窗口函数count(*) over ()
+    window_count = False
+
+    async def create_pool(self, loop, **kw):
+        raise NotImplementedError()
+
+    # 中止连接上正在执行的语句，pool为连接所属的连接池
+    async def interrupt(self, pool, conn):
+        pass
+
+    # 从create_pool的参数中取出连接池的参数
+    def pool_options(self, kw):
+        return {k: kw[k] for k in ('minsize', 'maxsize', 'limit', 'warmup', 'max_lifetime', 'target_wait', 'interval') if k in kw}
+
+    # 将SQL语句的占位符?替换为数据库的占位符
+    def translate(self, sql):
+        return sql
+
+    # 打开游标，as_tuple=True时返回元组，unbuffered=True时使用无缓冲的游标
+    def cursor(self, conn, as_tuple=False, unbuffered=False):
+        raise NotImplementedError()
+
+    # 建表语句中是否直接包含索引，不包含时需另外执行create index
+    inline_indexes = False
+
+    # 根据Model生成建表语句
+    def create_table_sql(self, model):
+        lines = ['    `%s` %s not null' % (f, model.__mappings__[f].column_type) for f in [model.__primary_key__] + model.__fields__]
+        if self.inline_indexes:
+            for index in model.__indexes__:
+                lines.append('    %skey `%s` (%s)' % ('unique ' if index.unique else '', index.name, ', '.join(map(lambda c: '`%s`' % c, index.key_columns))))
+        lines.append('    primary key (`%s`)' % model.__primary_key__)
+        return 'create table if not exists `%s` (\n%s\n)' % (model.__table__, ',\n'.join(lines))
+
+    # 数据库中的索引名
+    def index_name(self, model, index):
+        return index.name
+
+    def create_index_sql(self, model, index, if_not_exists=False):
+        return 'create %sindex %s`%s` on `%s` (%s)' % ('unique ' if index.unique else '', 'if not exists ' if if_not_exists else '', self.index_name(model, index), model.__table__, ', '.join(map(lambda c: '`%s`' % c, index.key_columns)))
+
+    def drop_index_sql(self, model, name):
+        return 'drop index `%s` on `%s`' % (name, model.__table__)
+
+    # 增加列，已有的行使用Field的默认值(不可用时为类型的零值)
+    def add_column_sql(self, model, name):
+        field = model.__mappings__[name]
+        default = field.default if field.default is not None and not callable(field.default) else ('' if isinstance(field, (StringField, TextField)) else 0)
+        if isinstance(default, str):
+            default = "'%s'" % default.replace("'", "''")
+        elif isinstance(default, bool):
+            default = int(default)
+        return 'alter table `%s` add column `%s` %s not null default %s' % (model.__table__, name, field.column_type, default)
+
+    # 规范化列类型，用于比较Model与数据库中的类型
+    def normalize_type(self, column_type):
+        return column_type.lower().strip()
+
+    # 读取数据库中的表结构：表名 => dict(columns={列名: 类型}, indexes={索引名: (是否唯一, 列名元组)})，不含主键索引
+    async def get_schema(self):
+        raise NotImplementedError()
+
+# 定义MySQL后端，基于aiomysql
+class MySQLBackend(Backend):
+
+    name = 'mysql'
+    approximate_rows_sql = 'select table_rows __num__ from information_schema.tables where table_schema=database() and table_name=?'
+
+    async def create_pool(self, loop, **kw):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is required by the mysql backend.')
+        async def connect():
+            return await aiomysql.connect(
+                host=kw.get('host', 'localhost'),
+                port=kw.get('port', 3306),
+                user=kw['user'],
+                password=kw['password'],
+                db=kw['db'],
+                charset=kw.get('charset', 'utf8'),  # 默认编码为UTF-8
+                autocommit=kw.get('autocommit', True),  # 默认自动提交
+                loop=loop
+            )
+        pool = MySQLPool(connect, **self.pool_options(kw))
+        await pool.fill()
+        # MySQL 8.0、MariaDB 10.2起支持窗口函数，主库与副本都支持时才使用
+        conn = await pool.acquire()
+        try:
+            self.window_count = self.__dict__.get('window_count', True) and self.supports_window(conn.get_server_info())
+        finally:
+            pool.release(conn)
+        return pool
+
+    # MySQL的TEXT/BLOB列不能有默认值(ER_BLOB_CANT_HAVE_DEFAULT)，省略默认值，已有的行使用类型的隐式默认值(空字符串)
+    def add_column_sql(self, model, name):
+        field = model.__mappings__[name]
+        if re.search(r'text|blob', field.column_type, re.IGNORECASE):
+            return 'alter table `%s` add column `%s` %s not null' % (model.__table__, name, field.column_type)
+        return super().add_column_sql(model, name)
+
+    @staticmethod
+    def supports_window(version):
+        m = re.match(r'(\d+)\.(\d+)', version)
+        if m is None:
+            return False
+        return tuple(map(int, m.groups())) >= ((10, 2) if 'mariadb' in version.lower() else (8, 0))
+
+    def translate(self, sql):
+        return sql.replace('?', '%s')  # 将SQL语句的占位符？替换为MySQL的占位符%s
+
+    # 另开一个不属于连接池的连接执行KILL QUERY，避免连接池耗尽时无法中止
+    async def interrupt(self, pool, conn):
+        side = await pool.open()
+        try:
+            async with side.cursor() as cur:
+                await cur.execute('kill query %d' % conn.thread_id())
+        finally:
+            side.close()
+
+    def cursor(self, conn, as_tuple=False, unbuffered=False):
+        if unbuffered:
+            return conn.cursor(aiomysql.SSCursor if as_tuple else aiomysql.SSDictCursor)
+        return conn.cursor(aiomysql.Cursor if as_tuple else aiomysql.DictCursor)
+
+    inline_indexes = True
+    # MySQL中的类型别名
+    type_aliases = dict(boolean='tinyint', bool='tinyint', real='double', integer='int')
+
+    def create_table_sql(self, model):
+        return '%s engine=innodb default charset=utf8' % super().create_table_sql(model)
+
+    def normalize_type(self, column_type):
+        t = re.sub(r'^(tinyint|smallint|mediumint|int|bigint)\(\d+\)', r'\1', column_type.lower().strip())
+        return self.type_aliases.get(t, t)
+
+    async def get_schema(self):
+        schema = collections.defaultdict(lambda: dict(columns={}, indexes={}))
+        for r in await select('select table_name t, column_name c, column_type ct from information_schema.columns where table_schema=database()', [], primary=True, cache=False):
+            schema[r['t']]['columns'][r['c']] = r['ct']
+        for r in await select("select table_name t, index_name i, non_unique nu, column_name c from information_schema.statistics where table_schema=database() and index_name<>'PRIMARY' order by table_name, index_name, seq_in_index", [], primary=True, cache=False):
+            unique, columns = schema[r['t']]['indexes'].get(r['i'], (not r['nu'], ()))
+            schema[r['t']]['indexes'][r['i']] = (unique, columns + (r['c'],))
+        return dict(schema)
+
+# 定义通用的连接池，connect为创建连接的协程函数，连接需提供close()方法及closed属性
+# 连接数上限在[limit, maxsize]之间自适应：每interval秒统计一次，因达到上限而排队的平均时间超过target_wait秒时调高，
+# 使用率低时调回；空闲连接多于本周期内同时使用的峰值时逐步关闭，但至少保留minsize个；
+# 打开超过max_lifetime秒的连接在归还或取出时关闭重建
+class Pool(object):
+
+    def __init__(self, connect, minsize=1, maxsize=10, limit=None, warmup=None, max_lifetime=3600, target_wait=0.005, interval=10):
+        self._connect = connect
+        self.minsize = min(minsize, maxsize)
+        self.maxsize = maxsize  # 连接数的硬上限
+        self.base_limit = min(limit or maxsize, maxsize)
+        self.limit = self.base_limit  # 当前的连接数上限
+        self.warmup = min(max(warmup or 0, self.minsize), self.limit)  # 启动时预先打开的连接数
+        self.max_lifetime = max_lifetime
+        self.target_wait = target_wait
+        self.interval = interval
+        self._free = collections.deque()  # 空闲的连接，右端为最近归还的
+        self._used = set()  # 使用中的连接
+        self._created = {}  # 连接 => 打开时间
+        self._opening = 0  # 正在打开的连接数
+        self._waiters = collections.deque()  # 等待连接的Future
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._acquires = 0
+        self._wait_time = 0
+        self._peak = len(self._used)
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used)
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    def __contains__(self, conn):
+        return conn in self._created
+
+    # 连接是否处于未结束的事务中
+    def in_transaction(self, conn):
+        return conn.in_transaction
+
+    # 打开一个不属于连接池的连接，用完由调用方关闭
+    async def open(self):
+        return await self._connect()
+
+    # 预先打开warmup个连接，避免启动后的第一波请求等待建立连接
+    async def fill(self):
+        n = self.warmup - self.size
+        if n > 0:
+            self._opening = self._opening + n
+            try:
+                conns = await asyncio.gather(*[self._connect() for i in range(n)], return_exceptions=True)
+            finally:
+                self._opening = self._opening - n
+            now = time.monotonic()
+            for conn in conns:
+                if not isinstance(conn, BaseException):
+                    self._created[conn] = now
+                    self._free.append(conn)
+            for conn in conns:
+                if isinstance(conn, BaseException):
+                    raise conn
+
+    async def acquire(self):
+        start = time.monotonic()
+        self._adjust(start)
+        while True:
+            conn = self._pop_free(start)
+            if conn is not None:
+                break
+            if self.size + self._opening < self.limit:
+                conn = await self._open()
+                break
+            fut = asyncio.get_event_loop().create_future()
+            self._waiters.append(fut)
+            queued = time.monotonic()
+            try:
+                conn = await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    if fut.result() is not None:
+                        self.release(fut.result())
+                    else:
+                        self._wakeup()
+                raise
+            finally:
+                # 只统计因达到上限而排队的时间，不含建立连接的时间
+                self._wait_time = self._wait_time + time.monotonic() - queued
+            if conn is not None:
+                break  # 归还连接的一方直接交给了本等待者
+        self._used.add(conn)
+        self._acquires = self._acquires + 1
+        self._peak = max(self._peak, len(self._used))
+        return conn
+
+    def release(self, conn):
+        self._used.discard(conn)
+        if conn.closed:
+            self._created.pop(conn, None)
+        elif self.in_transaction(conn):
+            # 未结束事务的连接状态不明，直接关闭
+            logging.warning('connection released in transaction, closing it')
+            self._close(conn)
+        elif self._expired(conn, time.monotonic()) or self.size >= self.limit:
+            # 超过最长使用时间，或上限调低后超出上限
+            self._close(conn)
+        else:
+            while self._waiters:
+                fut = self._waiters.popleft()
+                if not fut.done():
+                    self._used.add(conn)
+                    fut.set_result(conn)
+                    return
+            self._free.append(conn)
+            return
+        self._wakeup()
+
+    def get(self):
+        return _PoolConnectionContext(self)
+
+    def close(self):
+        while self._free:
+            self._close(self._free.popleft())
+
+    async def wait_closed(self):
+        pass
+
+    async def _open(self):
+        self._opening = self._opening + 1
+        try:
+            conn = await self._connect()
+        except BaseException:
+            self._wakeup()
+            raise
+        finally:
+            self._opening = self._opening - 1
+        self._created[conn] = time.monotonic()
+        return conn
+
+    def _close(self, conn):
+        self._created.pop(conn, None)
+        conn.close()
+
+    def _expired(self, conn, now):
+        return self.max_lifetime is not None and now - self._created.get(conn, now) > self.max_lifetime
+
+    # 空闲期间是否已被服务端断开，子类根据连接的实现判断
+    def _stale(self, conn):
+        return False
+
+    # 取出最近归还的空闲连接，跳过已关闭、已被服务端断开或超过最长使用时间的连接
+    def _pop_free(self, now):
+        while self._free:
+            conn = self._free.pop()
+            if conn.closed:
+                self._created.pop(conn, None)
+            elif self._expired(conn, now) or self._stale(conn):
+                self._close(conn)
+            else:
+                return conn
+        return None
+
+    # 连接数减少后，唤醒一个等待者自行打开新连接
+    def _wakeup(self):
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+    # 每interval秒根据等待时间及使用峰值调整连接数上限，并关闭多余的空闲连接
+    def _adjust(self, now):
+        if now - self._window_start < self.interval:
+            return
+        wait = self._wait_time / self._acquires if self._acquires else 0
+        if wait > self.target_wait and self.limit < self.maxsize:
+            self.limit = min(self.maxsize, self.limit + max(1, self.limit // 2))
+            logging.info('pool limit raised to %s (average acquire wait %.4fs)' % (self.limit, wait))
+        elif self._peak * 2 < self.limit and self.limit > self.base_limit:
+            self.limit = max(self.base_limit, self._peak * 2)
+            logging.info('pool limit lowered to %s (peak in use %s)' % (self.limit, self._peak))
+        # 每次关闭一半多余的空闲连接，从空闲最久的开始
+        surplus = min(self.freesize, self.size - max(self.minsize, self._peak))
+        for i in range((surplus + 1) // 2):
+            self._close(self._free.popleft())
+        self._reset_window(now)
+
+# 定义aiomysql连接使用的连接池
+class MySQLPool(Pool):
+
+    def in_transaction(self, conn):
+        return conn.get_transaction_status()
+
+    # 同aiomysql.Pool：服务端关闭空闲超过wait_timeout的连接后，连接的closed仍为False，需检查读取流的状态；
+    # MySQL 8.0关闭前会先发送错误包，at_eof()不成立，需检查eof_received
+    def _stale(self, conn):
+        reader = conn._reader
+        return reader is None or reader.at_eof() or reader.exception() is not None or getattr(reader, 'eof_received', False)
+
+class _PoolConnectionContext(object):
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        self._conn = await self._pool.acquire()
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._pool.release(self._conn)
+        self._conn = None
+
+# 定义SQLite的异步连接，sqlite3的调用在线程池中执行，避免阻塞事件循环
+class SQLiteConnection(object):
+
+    def __init__(self, db, loop):
+        self._db = db
+        self._loop = loop
+        self.closed = False
+
+    @property
+    def in_transaction(self):
+        return self._db.in_transaction
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(None, fn, *args)
+
+    def cursor(self, as_tuple=False):
+        return SQLiteCursor(self, as_tuple)
+
+    # 中止正在执行的语句，可在其他线程中调用
+    def interrupt(self):
+        if not self.closed:
+            self._db.interrupt()
+
+    async def begin(self):
+        await self._run(self._db.execute, 'begin')
+
+    async def commit(self):
+        await self._run(self._db.commit)
+
+    async def rollback(self):
+        await self._run(self._db.rollback)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._db.close()
+
+# 定义SQLite的异步游标，接口与aiomysql的游标一致
+class SQLiteCursor(object):
+
+    def __init__(self, conn, as_tuple=False):
+        self._conn = conn
+        self._cur = None
+        self._as_tuple = as_tuple
+        self._names = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        self._cur = self._conn._db.cursor()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._cur.close()
+
+    async def execute(self, sql, args=()):
+        await self._conn._run(self._cur.execute, sql, tuple(args))
+        self.rowcount = self._cur.rowcount
+        if self._cur.description is not None:
+            self._names = [d[0] for d in self._cur.description]
+
+    async def executemany(self, sql, seq_of_args):
+        await self._conn._run(self._cur.executemany, sql, [tuple(args) for args in seq_of_args])
+        self.rowcount = self._cur.rowcount
+
+    def _rows(self, rs):
+        if self._as_tuple:
+            return rs
+        return [dict(zip(self._names, r)) for r in rs]
+
+    async def fetchall(self):
+        return self._rows(await self._conn._run(self._cur.fetchall))
+
+    async def fetchmany(self, size):
+        return self._rows(await self._conn._run(self._cur.fetchmany, size))
+
+# 定义SQLite后端，db为数据库文件路径，便于在没有MySQL的环境中运行应用、压测及基准测试
+class SQLiteBackend(Backend):
+
+    name = 'sqlite'
+    explain_prefix = 'explain query plan '
+    insert_ignore = 'insert or ignore'
+    window_count = sqlite3.sqlite_version_info >= (3, 25, 0)
+
+    async def create_pool(self, loop, **kw):
+        path = kw.get('db', ':memory:')
+        loop = loop or asyncio.get_event_loop()
+        def open_db():
+            db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            db.execute('pragma busy_timeout = %d' % kw.get('busy_timeout', 5000))
+            if path != ':memory:':
+                db.execute('pragma journal_mode = wal')  # WAL模式下读写互不阻塞
+            return db
+        async def connect():
+            return SQLiteConnection(await loop.run_in_executor(None, open_db), loop)
+        options = self.pool_options(kw)
+        if path == ':memory:':
+            # 每个连接打开的:memory:都是独立的数据库，只能使用一个连接，且不能关闭重建
+            options.update(minsize=1, maxsize=1, max_lifetime=None)
+        pool = Pool(connect, **options)
+        await pool.fill()
+        return pool
+
+    def cursor(self, conn, as_tuple=False, unbuffered=False):
+        return conn.cursor(as_tuple)
+
+    # SQLite的索引名在整个数据库内唯一，加上表名前缀
+    async def interrupt(self, pool, conn):
+        conn.interrupt()
+
+    def index_name(self, model, index):
+        return '%s_%s' % (model.__table__, index.name)
+
+    def drop_index_sql(self, model, name):
+        return 'drop index `%s`' % name
+
+    async def get_schema(self):
+        schema = {}
+        for t in await select("select name from sqlite_master where type='table' and name not like 'sqlite_%'", [], primary=True, cache=False):
+            table = schema[t['name']] = dict(columns={}, indexes={})
+            for c in await select('pragma table_info(`%s`)' % t['name'], [], primary=True, cache=False):
+                table['columns'][c['name']] = c['type']
+            for i in await select('pragma index_list(`%s`)' % t['name'], [], primary=True, cache=False):
+                if i['origin'] == 'pk':
+                    continue
+                columns = await select('pragma index_info(`%s`)' % i['name'], [], primary=True, cache=False)
+                table['indexes'][i['name']] = (bool(i['unique']), tuple(c['name'] for c in columns))
+        return schema
+
+__backends = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+# 创建连接池，backend为数据库后端(mysql或sqlite)，replicas为只读副本的配置列表，未指定的参数沿用主库配置
+# timeout为单条语句的默认超时秒数，为None时不限制
+async def create_pool(loop, replicas=None, backend='mysql', timeout=None, **kw):
     logging.info('create database connection pool...')
-    global __pool  # 定义全局变量__pool存储连接池
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),  # 默认编码为UTF-8
-        autocommit=kw.get('autocommit', True),  # 默认自动提交
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    global __backend, __pool, __replicas, __replica_cycle, __timeout  # 定义全局变量__pool存储连接池
+    if backend not in __backends:
+        raise ValueError('Invalid backend: %s' % backend)
+    __timeout = timeout
+    __backend = __backends[backend]()
+    __pool = await __backend.create_pool(loop, **kw)
+    __replicas = []
+    for replica in replicas or []:
+        logging.info('create replica connection pool: %s' % replica.get('host', kw.get('host', 'localhost')))
+        __replicas.append(await __backend.create_pool(loop, **dict(kw, **replica)))
+    __replica_cycle = itertools.cycle(__replicas) if __replicas else None
+
+def get_backend():
+    return __backend
+
+# 根据Model建表，表已存在时跳过
+async def create_tables(*models):
+    for model in models:
+        await execute(__backend.create_table_sql(model), [])
+        if not __backend.inline_indexes:
+            for index in model.__indexes__:
+                await execute(__backend.create_index_sql(model, index, if_not_exists=True), [])
+    # 建表不需要读自己的写入，避免启动时的上下文(及其派生的请求)被固定到主库
+    _read_your_writes.set(False)
+
+# 匹配SQL中的字符串常量或连续空白
+_RE_WHITESPACE = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")|\s+")
+# 匹配SQL中涉及的表名
+_RE_TABLES = re.compile(r'\b(?:from|join|into|update)\s+`?(\w+)`?', re.IGNORECASE)
+
+# 规范化SQL：合并字符串常量以外的连续空白
+def normalize_sql(sql):
+    return _RE_WHITESPACE.sub(lambda m: m.group(1) or ' ', sql).strip()
+
+# 获取SQL语句涉及的表名
+def get_tables(sql):
+    return set(map(lambda t: t.lower(), _RE_TABLES.findall(sql)))
+
+# 匹配SQL中的字符串及数字常量
+_RE_LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b")
+# 匹配IN列表及多行VALUES
+_RE_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+
+# 获取语句的形状：常量替换为?，IN列表及多行VALUES合并为(...)，用于统计及去重
+def get_shape(sql):
+    return _RE_IN_LIST.sub('(...)', _RE_LITERALS.sub('?', normalize_sql(sql)))
+
+# 定义直方图，按固定的桶统计数值分布
+class Histogram(object):
+
+    TIME_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)  # 秒
+    ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个桶统计超过上限的数值
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    # 估算百分位数，返回所在桶的上限
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        n = 0
+        for i, c in enumerate(self.counts):
+            n = n + c
+            if n >= p * self.count:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        return dict(count=self.count, sum=self.sum, min=self.min, max=self.max, p50=self.percentile(0.5), p99=self.percentile(0.99), buckets=list(self.buckets), counts=list(self.counts))
+
+# 定义连接池及语句的统计：获取连接的等待时间、每种语句的执行时间及返回行数
+class Metrics(object):
+
+    def __init__(self, max_statements=1000):
+        self.max_statements = max_statements  # 最多统计的语句形状数，超出的归入'(other)'
+        self.acquire_wait = Histogram()
+        self.statements = {}  # 语句形状 => dict(time=Histogram, rows=Histogram)
+
+    def record_acquire(self, wait):
+        self.acquire_wait.observe(wait)
+
+    def record_statement(self, shape, elapsed, rows):
+        stat = self.statements.get(shape, None)
+        if stat is None:
+            if len(self.statements) >= self.max_statements:
+                shape = '(other)'
+            stat = self.statements.setdefault(shape, dict(time=Histogram(), rows=Histogram(Histogram.ROW_BUCKETS)))
+        stat['time'].observe(elapsed)
+        stat['rows'].observe(rows)
+
+    def snapshot(self):
+        return dict(
+            pools=get_pool_stats(),
+            acquire_wait=self.acquire_wait.to_dict(),
+            statements={k: dict(time=v['time'].to_dict(), rows=v['rows'].to_dict()) for k, v in self.statements.items()}
+        )
+
+    def reset(self):
+        self.acquire_wait = Histogram()
+        self.statements = {}
+
+__metrics = Metrics()
+__hooks = []  # 统计事件的回调函数，参数为事件dict
+
+def get_metrics():
+    return __metrics
+
+# 添加统计事件的回调，如导出到监控系统：
+#     acquire事件：dict(event='acquire', wait=等待秒数, pool=连接池)
+#     statement事件：dict(event='statement', sql=SQL, shape=语句形状, args=参数, elapsed=执行秒数, rows=行数)
+def add_hook(fn):
+    __hooks.append(fn)
+
+def remove_hook(fn):
+    __hooks.remove(fn)
+
+def _emit(event):
+    for fn in __hooks:
+        try:
+            fn(event)
+        except Exception as e:
+            logging.exception(e)
+
+# 记录获取连接的等待时间
+def record_acquire(wait, pool):
+    __metrics.record_acquire(wait)
+    if __hooks:
+        _emit(dict(event='acquire', wait=wait, pool=pool))
+
+# 记录语句的执行时间及行数
+def record_statement(sql, args, elapsed, rows):
+    shape = get_shape(sql)
+    __metrics.record_statement(shape, elapsed, rows)
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.record(shape, elapsed)
+    if __hooks:
+        _emit(dict(event='statement', sql=sql, shape=shape, args=args, elapsed=elapsed, rows=rows))
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+# 定义一个请求的语句统计：语句数超过budget，或同一形状的语句超过repeat次(常见于循环中逐行查询的N+1问题)时
+# 记录警告，strict=True时抛出QueryBudgetExceeded；为None的阈值不检查
+class QueryStats(object):
+
+    def __init__(self, name=None, budget=None, repeat=None, strict=False):
+        self.name = name
+        self.budget = budget
+        self.repeat = repeat
+        self.strict = strict
+        self.count = 0
+        self.time = 0  # 数据库耗时，秒
+        self.shapes = collections.Counter()
+        self._warned = set()
+
+    def record(self, shape, elapsed):
+        self.count = self.count + 1
+        self.time = self.time + elapsed
+        self.shapes[shape] += 1
+        if self.budget is not None and self.count > self.budget:
+            self._exceeded('budget', 'query budget exceeded: %s > %s statements' % (self.count, self.budget))
+        if self.repeat is not None and self.shapes[shape] > self.repeat:
+            self._exceeded(shape, 'possible N+1 query: %s times: %s' % (self.shapes[shape], shape))
+
+    def _exceeded(self, key, message):
+        if self.name:
+            message = '%s (%s)' % (message, self.name)
+        if self.strict:
+            raise QueryBudgetExceeded(message)
+        if key not in self._warned:
+            self._warned.add(key)
+            logging.warning(message)
+
+# 统计当前上下文中执行的语句，参数见QueryStats，如在中间件中统计一个请求：
+#     with orm.track_queries('GET /', budget=20, repeat=5) as stats:
+#         r = await handler(request)
+#     logging.info('%s statements, %.3fs' % (stats.count, stats.time))
+@contextlib.contextmanager
+def track_queries(name=None, budget=None, repeat=None, strict=False):
+    stats = QueryStats(name, budget, repeat, strict)
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+# 获取各连接池的使用情况
+def get_pool_stats():
+    pools = [('primary', __pool)] if __pool is not None else []
+    pools.extend(('replica%s' % i, p) for i, p in enumerate(__replicas))
+    return {name: dict(size=p.size, idle=p.freesize, in_use=p.size - p.freesize, minsize=p.minsize, limit=p.limit, maxsize=p.maxsize) for name, p in pools}
+
+# 隐藏参数中的字符串内容，只保留类型和长度
+def redact_args(args):
+    if args and isinstance(args[0], (list, tuple)):
+        return '<%s rows>' % len(args)  # executemany的多组参数
+    def redact(v):
+        if v is None or isinstance(v, (bool, int, float)):
+            return v
+        if isinstance(v, (str, bytes)):
+            return '<%s:%s>' % (type(v).__name__, len(v))
+        return '<%s>' % type(v).__name__
+    return [redact(v) for v in args or ()]
+
+# 定义慢查询日志：作为统计事件的回调，执行时间超过threshold秒的语句记录耗时、行数、隐藏内容的参数及执行计划；
+# 同一形状的语句interval秒内只记录一次，并统计被合并的次数
+class SlowQueryLog(object):
+
+    def __init__(self, threshold=0.5, interval=60, explain=True, max_shapes=1000):
+        self.threshold = threshold
+        self.interval = interval
+        self.explain = explain
+        self.max_shapes = max_shapes
+        self._logged = {}  # 语句形状 => [上次记录的时间, 之后被合并的次数]
+
+    def __call__(self, event):
+        if event['event'] != 'statement' or event['elapsed'] < self.threshold:
+            return
+        now = time.monotonic()
+        shape = event['shape']
+        logged = self._logged.get(shape, None)
+        if logged is not None and logged[0] + self.interval > now:
+            logged[1] = logged[1] + 1
+            return
+        suppressed = logged[1] if logged is not None else 0
+        if logged is None and len(self._logged) >= self.max_shapes:
+            self._logged = {k: v for k, v in self._logged.items() if v[0] + self.interval > now}
+        self._logged[shape] = [now, 0]
+        logging.warning('slow query: %.3fs, rows: %s, args: %s, suppressed: %s, SQL: %s' % (event['elapsed'], event['rows'], redact_args(event['args']), suppressed, shape))
+        if self.explain and get_backend().explain_prefix and event['sql'].lstrip()[:6].lower() == 'select':
+            asyncio.ensure_future(self._explain(event['sql'], event['args'], shape))
+
+    # 在另外的连接上查看执行计划，不占用事务的连接，也不计入统计
+    async def _explain(self, sql, args, shape):
+        backend = get_backend()
+        try:
+            async with get_read_pool().get() as conn:
+                async with backend.cursor(conn, as_tuple=True) as cur:
+                    await cur.execute(backend.translate(backend.explain_prefix + sql), args or ())
+                    rs = await cur.fetchall()
+            logging.warning('slow query plan: %s\n%s' % (shape, '\n'.join(map(str, rs))))
+        except Exception as e:
+            logging.warning('failed to explain slow query: %s' % e)
+
+# 开启慢查询日志
+def enable_slow_query_log(threshold=0.5, interval=60, explain=True):
+    logging.info('enable slow query log: threshold=%s, interval=%s' % (threshold, interval))
+    slowLog = SlowQueryLog(threshold, interval, explain)
+    add_hook(slowLog)
+    return slowLog
+
+# 定义查询结果缓存：以规范化的SQL和参数为键，LRU淘汰并按TTL过期，按表名打标签，写表时失效
+class QueryCache(object):
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key => (过期时间, 表名集合, 结果集)
+        self._keys = collections.defaultdict(set)  # 表名 => 缓存键集合
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0  # 每次失效加1，查询期间发生过失效的结果不写入缓存
+
+    def get(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            self.evictions = self.evictions + 1
+            self.misses = self.misses + 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits = self.hits + 1
+        return entry[2]
+
+    def put(self, key, tables, rs, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, tables, rs)
+        for t in tables:
+            self._keys[t].add(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+            self.evictions = self.evictions + 1
+
+    # 使表名相关的所有缓存失效
+    def invalidate(self, tables):
+        self.generation = self.generation + 1
+        for t in tables:
+            for key in list(self._keys.pop(t, ())):
+                self._remove(key)
+                self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        self._entries.clear()
+        self._keys.clear()
+
+    def _remove(self, key):
+        _, tables, _ = self._entries.pop(key)
+        for t in tables:
+            keys = self._keys.get(t, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys[t]
+
+    def stats(self):
+        return dict(size=len(self._entries), maxsize=self.maxsize, ttl=self.ttl, hits=self.hits, misses=self.misses, evictions=self.evictions, invalidations=self.invalidations)
+
+__query_cache = None  # 查询结果缓存，默认关闭
+
+# 开启查询结果缓存
+def enable_query_cache(maxsize=1024, ttl=60):
+    global __query_cache
+    logging.info('enable query cache: maxsize=%s, ttl=%s' % (maxsize, ttl))
+    __query_cache = QueryCache(maxsize, ttl)
+    return __query_cache
+
+# 获取查询结果缓存，未开启时返回None
+def get_query_cache():
+    return __query_cache
+
+# 匹配统计行数的表达式：count(*)、count(1)、count(列名)
+_RE_ROW_COUNT = re.compile(r'^count\(\s*(\*|1|`?\w+`?)\s*\)$', re.IGNORECASE)
+
+# 定义行数缓存：无WHERE条件的行数由Model的save/remove增量维护，超过reconcile秒后重新统计；
+# 带WHERE条件的统计结果无法增量维护，表被写入时失效
+class CountCache(object):
+
+    def __init__(self, reconcile=300, approximate_threshold=1000000):
+        self.reconcile = reconcile
+        self.approximate_threshold = approximate_threshold  # 估算行数超过该值时才使用估算值
+        self._entries = {}  # (表名, 统计表达式, WHERE, 参数) => [行数, 统计时间, 是否可增量维护]
+        self.hits = 0
+        self.misses = 0
+        self.reconciles = 0
+        self.generation = 0  # 每次调整或失效加1，统计期间发生过写入的结果不写入缓存
+
+    def get(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+        if entry[1] + self.reconcile < time.monotonic():
+            self.reconciles = self.reconciles + 1
+            return None
+        self.hits = self.hits + 1
+        return entry[0]
+
+    def put(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        table, selectField, where, _ = key
+        self._entries[key] = [value, time.monotonic(), where is None and _RE_ROW_COUNT.match(selectField.strip()) is not None]
+
+    # 增量调整无WHERE条件的行数，并使其他统计结果失效
+    def adjust(self, table, delta):
+        self.generation = self.generation + 1
+        for key, entry in list(self._entries.items()):
+            if key[0] == table:
+                if entry[2]:
+                    entry[0] = entry[0] + delta
+                else:
+                    del self._entries[key]
+
+    # 使带WHERE条件的统计结果失效
+    def invalidate(self, tables):
+        self.generation = self.generation + 1
+        for key, entry in list(self._entries.items()):
+            if key[0] in tables and not entry[2]:
+                del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return dict(size=len(self._entries), reconcile=self.reconcile, hits=self.hits, misses=self.misses, reconciles=self.reconciles)
+
+__count_cache = None  # 行数缓存，默认关闭
+
+# 开启行数缓存
+def enable_count_cache(reconcile=300, approximate_threshold=1000000):
+    global __count_cache
+    logging.info('enable count cache: reconcile=%s, approximate_threshold=%s' % (reconcile, approximate_threshold))
+    __count_cache = CountCache(reconcile, approximate_threshold)
+    return __count_cache
+
+# 获取行数缓存，未开启时返回None
+def get_count_cache():
+    return __count_cache
+
+# 写操作后使涉及的表的缓存失效，事务中的写操作在提交或回滚时再次失效
+def invalidate_cache(sql):
+    tables = get_tables(sql)
+    tx = _transaction.get()
+    if tx is not None:
+        tx._tables.update(tables)
+    invalidate_tables(tables)
+
+def invalidate_tables(tables):
+    if __query_cache is not None:
+        __query_cache.invalidate(tables)
+    if __count_cache is not None:
+        __count_cache.invalidate(tables)
+
+# Model增删记录后增量调整行数缓存，事务中的调整在提交后才生效
+def adjust_count(table, delta):
+    if __count_cache is not None and delta:
+        tx = _transaction.get()
+        if tx is not None:
+            tx._counts.append((table, delta))
+        else:
+            __count_cache.adjust(table.lower(), delta)
+
+# 当前上下文是否在事务中
+def in_transaction():
+    return _transaction.get() is not None
+
+def get_pool():
+    return __pool
+
+# 定义事务，事务中的select、execute及Model的各种操作都使用同一个连接，退出时统一提交或回滚：
+#     async with orm.transaction() as tx:
+#         await blog.remove()
+#         await Comment.remove_many(comments)
+class Transaction(object):
+
+    def __init__(self):
+        self.conn = None
+        self.lock = asyncio.Lock()  # 同一连接上的语句需依次执行
+        self._pool = None
+        self._token = None
+        self._tables = set()  # 事务中写过的表
+        self._counts = []  # 事务提交后才生效的行数调整
+
+    async def __aenter__(self):
+        if _transaction.get() is not None:
+            raise RuntimeError('Nested transaction is not supported.')
+        self._pool = get_pool()
+        start = time.monotonic()
+        self.conn = await self._pool.acquire()
+        record_acquire(time.monotonic() - start, self._pool)
+        try:
+            await self.conn.begin()
+        except BaseException:
+            self._pool.release(self.conn)
+            raise
+        self._token = _transaction.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _transaction.reset(self._token)
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+                for table, delta in self._counts:
+                    adjust_count(table, delta)
+            else:
+                await self.conn.rollback()
+        finally:
+            self._pool.release(self.conn)
+            invalidate_tables(self._tables)
+            if self._tables:
+                _read_your_writes.set(True)
+        return False
+
+def transaction():
+    return Transaction()
+
+# 获取连接：事务中使用事务固定的连接，否则从连接池获取，只读操作可使用副本
+# until为截止时间，等待连接超过截止时间时抛出asyncio.TimeoutError
+@contextlib.asynccontextmanager
+async def connection(readonly=False, primary=False, until=None):
+    tx = _transaction.get()
+    if tx is None:
+        # 固定在主库上的连接可用于读写，固定在副本上的只用于读
+        pin = _pinned.get()
+        if pin is not None and (pin.primary or (readonly and not primary)):
+            tx = pin
+    if tx is not None:
+        async with tx.lock:
+            yield tx.conn
+        return
+    pool = get_read_pool(primary) if readonly else __pool
+    start = time.monotonic()
+    remaining = get_remaining(until)
+    conn = await asyncio.wait_for(pool.acquire(), remaining)
+    try:
+        record_acquire(time.monotonic() - start, pool)
+        yield conn
+    finally:
+        pool.release(conn)
+
+# 定义固定的连接
+class _Pin(object):
+
+    def __init__(self, conn, primary):
+        self.conn = conn
+        self.primary = primary
+        self.lock = asyncio.Lock()
+
+# 在上下文中固定使用一个连接，多条语句不必各自获取连接：
+#     async with orm.pinned():
+#         num = await Blog.findNumber('count(id)')
+#         blogs = await Blog.findAll(limit=(0, 10))
+# 已在事务或固定连接中时沿用原来的连接
+@contextlib.asynccontextmanager
+async def pinned(primary=False):
+    if _transaction.get() is not None or _pinned.get() is not None:
+        yield
+        return
+    primary = primary or __replica_cycle is None or _read_your_writes.get()
+    async with connection(True, primary) as conn:
+        token = _pinned.set(_Pin(conn, primary))
+        try:
+            yield
+        finally:
+            _pinned.reset(token)
+
+# 并发执行互不依赖的查询，各自使用连接池中的连接，返回与参数顺序一致的结果列表：
+#     blog, comments = await orm.gather(Blog.find(id), Comment.findAll('blog_id=?', [id]))
+# limit限制同时执行的数量；任一查询失败时取消其余的查询并抛出该异常。
+# 事务或固定连接中只有一个连接，依次执行
+async def gather(*aws, limit=4):
+    if in_transaction() or _pinned.get() is not None:
+        results = []
+        try:
+            for aw in aws:
+                results.append(await aw)
+        except BaseException:
+            for aw in aws[len(results) + 1:]:
+                if asyncio.iscoroutine(aw):
+                    aw.close()
+            raise
+        return results
+    sem = asyncio.Semaphore(limit) if limit else None
+    async def run(aw):
+        if sem is None:
+            return await aw
+        async with sem:
+            return await aw
+    tasks = [asyncio.ensure_future(run(aw)) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+# 限制当前上下文中所有数据库操作的总耗时，如在中间件中限制一个请求：
+#     with orm.deadline(10):
+#         return await handler(request)
+# 嵌套时取较早的截止时间
+@contextlib.contextmanager
+def deadline(seconds):
+    until = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(until if current is None else min(current, until))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+# 计算语句的截止时间：取timeout(默认为create_pool的timeout)与上下文截止时间中较早的一个，都没有时返回None
+def get_deadline(timeout=None):
+    if timeout is None:
+        timeout = __timeout
+    until = _deadline.get()
+    if timeout is not None:
+        until = time.monotonic() + timeout if until is None else min(until, time.monotonic() + timeout)
+    return until
+
+# 距截止时间的剩余秒数，已超过截止时间时抛出asyncio.TimeoutError
+def get_remaining(until):
+    if until is None:
+        return None
+    remaining = until - time.monotonic()
+    if remaining <= 0:
+        raise asyncio.TimeoutError('database deadline exceeded')
+    return remaining
+
+# 在conn上执行coro，超时或调用方被取消(如客户端断开连接)时中止数据库中正在执行的语句，
+# 等待其结束后连接可以正常归还连接池；中止后仍未结束的连接直接关闭
+async def run_statement(conn, coro, until=None):
+    try:
+        remaining = get_remaining(until)
+    except asyncio.TimeoutError:
+        coro.close()
+        raise
+    task = asyncio.ensure_future(coro)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), remaining)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        if not task.done():
+            logging.warning('interrupting statement on timeout or cancellation')
+            pool = next((p for p in [__pool] + __replicas if conn in p), None)
+            try:
+                if pool is not None:
+                    await __backend.interrupt(pool, conn)
+            except Exception as e:
+                logging.exception(e)
+            done, _ = await asyncio.wait([task], timeout=INTERRUPT_TIMEOUT)
+            if not done:
+                task.cancel()
+                conn.close()
+        if task.done() and not task.cancelled():
+            task.exception()  # 语句被中止时的异常已由超时或取消代替
+        raise
+
+INTERRUPT_TIMEOUT = 1  # 中止语句后等待其结束的秒数
+
+# 选择读操作使用的连接池：副本间轮询，本上下文写过数据或指定primary时使用主库
+def get_read_pool(primary=False):
+    if primary or __replica_cycle is None or _read_your_writes.get():
+        return __pool
+    return next(__replica_cycle)
 
 # 定义select函数
-async def select(sql, args, size=None):
+# as_tuple=True时返回元组而非dict，用于紧凑行对象
+# 开启缓存时，未指定primary的查询先查缓存，cache=False可跳过缓存
+# timeout为本条语句的超时秒数，超时抛出asyncio.TimeoutError
+async def select(sql, args, size=None, primary=False, as_tuple=False, cache=True, timeout=None):
     log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:  # 打开游标
-            await cur.execute(sql.replace('?', '%s'), args or ())  # 将SQL语句的占位符？替换为MySQL的占位符%s
-            if size:
-                rs = await cur.fetchmany(size)  # 获取最多指定size数量的记录
-            else:
-                rs = await cur.fetchall()  # 获取所有记录
+    key = None
+    if __query_cache is not None and cache and not primary and not in_transaction():
+        key = (normalize_sql(sql), tuple(args or ()), size, as_tuple)
+        rs = __query_cache.get(key)
+        if rs is not None:
+            logging.info('rows returned from cache: %s' % len(rs))
+            return list(rs)
+        generation = __query_cache.generation
+    until = get_deadline(timeout)
+    async with connection(True, primary, until) as conn:
+        start = time.monotonic()
+        async def query():
+            async with __backend.cursor(conn, as_tuple) as cur:  # 打开游标
+                await cur.execute(__backend.translate(sql), args or ())  # 将SQL语句的占位符？替换为数据库的占位符
+                if size:
+                    return await cur.fetchmany(size)  # 获取最多指定size数量的记录
+                return await cur.fetchall()  # 获取所有记录
+        rs = await run_statement(conn, query(), until)
+        record_statement(sql, args, time.monotonic() - start, len(rs))
         logging.info('rows returned: %s' % len(rs))
+        if key is not None:
+            __query_cache.put(key, get_tables(sql), list(rs), generation)
         return rs  # 返回查询结果
 
+# 定义stream函数，使用无缓冲的服务端游标(SSDictCursor)分批读取，逐行返回大结果集
+# timeout从开始查询时计算，包含调用方处理每行的时间
+# 事务或固定连接中只有一个连接，无缓冲的游标读完前不能执行其他语句，因此一次读取全部结果后再逐行返回，
+# 不在返回每行时占用连接的锁
+async def stream(sql, args, batch=1000, primary=False, as_tuple=False, timeout=None):
+    if in_transaction() or _pinned.get() is not None:
+        for r in await select(sql, args, primary=primary, as_tuple=as_tuple, cache=False, timeout=timeout):
+            yield r
+        return
+    log(sql, args)
+    until = get_deadline(timeout)
+    async with connection(True, primary, until) as conn:
+        n = 0
+        elapsed = 0  # 只统计数据库的耗时，不含调用方处理每行的时间
+        try:
+            start = time.monotonic()
+            async with __backend.cursor(conn, as_tuple, unbuffered=True) as cur:
+                await run_statement(conn, cur.execute(__backend.translate(sql), args or ()), until)
+                while True:
+                    rs = await run_statement(conn, cur.fetchmany(batch), until)
+                    elapsed = elapsed + time.monotonic() - start
+                    if not rs:
+                        break
+                    n = n + len(rs)
+                    for r in rs:
+                        yield r
+                    start = time.monotonic()
+        finally:
+            record_statement(sql, args, elapsed, n)
+        logging.info('rows streamed: %s' % n)
+
 # 定义通用的execute函数，可执行Insert、Update、Delete语句
-async def execute(sql, args, autocommit=True):
+# 事务中执行时autocommit参数无效，由事务统一提交
+async def execute(sql, args, autocommit=True, timeout=None):
     log(sql)
-    async with __pool.get() as conn:
+    autocommit = autocommit or in_transaction()
+    until = get_deadline(timeout)
+    async with connection(until=until) as conn:
         if not autocommit:
             await conn.begin()  # 如果不是自动提交，则开始事务
         try:  # 无论是否自动提交，都执行try中代码
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args or ())
-                affected = cur.rowcount
+            start = time.monotonic()
+            async def query():
+                async with __backend.cursor(conn) as cur:
+                    await cur.execute(__backend.translate(sql), args or ())
+                    return cur.rowcount
+            affected = await run_statement(conn, query(), until)
+            record_statement(sql, args, time.monotonic() - start, affected)
             if not autocommit:
                 await conn.commit()  # 如果不是自动提交，则提交事务
         except BaseException:
-            if not autocommit:
+            if not autocommit and not conn.closed:
                 await conn.rollback()  # 如果不是自动提交，则回退事务
             raise
+        finally:
+            _read_your_writes.set(True)
+            invalidate_cache(sql)
         return affected  # 返回受影响的行数
 
+# 定义executemany函数，在同一个连接上用多组参数批量执行同一条语句
+async def executemany(sql, seq_of_args, autocommit=True, timeout=None):
+    log(sql)
+    autocommit = autocommit or in_transaction()
+    until = get_deadline(timeout)
+    async with connection(until=until) as conn:
+        if not autocommit:
+            await conn.begin()
+        try:
+            start = time.monotonic()
+            async def query():
+                async with __backend.cursor(conn) as cur:
+                    await cur.executemany(__backend.translate(sql), seq_of_args)
+                    return cur.rowcount
+            affected = await run_statement(conn, query(), until)
+            record_statement(sql, seq_of_args, time.monotonic() - start, affected)
+            if not autocommit:
+                await conn.commit()
+        except BaseException:
+            if not autocommit and not conn.closed:
+                await conn.rollback()
+            raise
+        finally:
+            _read_your_writes.set(True)
+            invalidate_cache(sql)
+        return affected
+
+# 将列表按chunk_size切分为多个批次
+def chunks(L, chunk_size):
+    for i in range(0, len(L), chunk_size):
+        yield L[i:i + chunk_size]
+
 # 创建问号序列，构造默认INSERT语句
 def create_args_string(num):
     L = []
@@ -66,14 +1302,42 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)  # ?, ?, ?, ?, ?, ?, ?
 
+# 将键集(keyset)的值编码为不透明的分页游标
+def encode_cursor(values):
+    s = json.dumps(list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+# 解码分页游标，返回键集的值列表
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii'))
+        values = json.loads(s.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return values
+
+# 构造键集分页条件：(a, b) < (?, ?) 展开为 a<? or (a=? and b<?)，MySQL 5.6可以使用索引
+def create_keyset_where(keyset, values):
+    conds = []
+    args = []
+    for i, k in enumerate(keyset):
+        cond = ['`%s`=?' % f for f in keyset[:i]]
+        cond.append('`%s`<?' % k)
+        conds.append('(%s)' % ' and '.join(cond))
+        args.extend(values[:i + 1])
+    return ' or '.join(conds), args
+
 # 定义Field类及其子类，负责保存数据库表的字段名、字段类型等数据
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, deferred=False):
         self.name = name  # 字段名
         self.column_type = column_type  # 列类型
         self.primary_key = primary_key  # 主键
         self.default = default  # 默认值
+        self.deferred = deferred  # 延迟加载，列表查询时可不读取该列
     
     def __str__(self):  # 定制print(Field('xx'))效果
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -84,6 +1348,13 @@ class StringField(Field):
     def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
         super().__init__(name, ddl, primary_key, default)
 
+# 定义ID类型，值为十进制字符串(64位整数超出JavaScript可精确表示的范围)
+# varchar按实际长度存储，默认宽度兼容旧的50位ID
+class IdField(Field):
+
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(50)'):
+        super().__init__(name, ddl, primary_key, default)
+
 # 定义布尔类型
 class BooleanField(Field):
 
@@ -105,8 +1376,165 @@ class FloatField(Field):
 # 定义text类型
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, deferred=True):
+        super().__init__(name, 'text', False, default, deferred)
+
+# 定义按主键查找的批量加载器：同一轮事件循环中发出的find(pk)合并为一条WHERE pk IN (...)查询
+class FindLoader(object):
+
+    def __init__(self, model):
+        self.model = model
+        self._pending = collections.OrderedDict()  # 主键 => [(等待结果的Future, 调用方的QueryStats)]
+        self._scheduled = False
+
+    def load(self, pk):
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(pk, []).append((fut, _query_stats.get()))
+        if not self._scheduled:
+            self._scheduled = True
+            # 本轮事件循环结束后再统一查询；合并的查询属于多个请求，在空白的上下文中执行，
+            # 不继承首个调用方的截止时间、固定连接及查询统计，其失败也不会来自某个请求的限制
+            loop.call_soon(self._dispatch, context=contextvars.Context())
+        return fut
+
+    def _dispatch(self):
+        pending = self._pending
+        self._pending = collections.OrderedDict()
+        self._scheduled = False
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        try:
+            with track_queries() as batch:
+                objs = await self.model.find_many(list(pending.keys()))
+        except BaseException as e:
+            for waiters in pending.values():
+                for fut, stats in waiters:
+                    if not fut.done():
+                        fut.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        # 合并的语句计入每个调用方的查询统计各一次，超出某个调用方的限制时只有该调用方失败
+        failed = {}
+        for stats in set(stats for waiters in pending.values() for fut, stats in waiters if stats is not None):
+            try:
+                for shape, n in batch.shapes.items():
+                    for i in range(n):
+                        stats.record(shape, batch.time / batch.count)
+            except QueryBudgetExceeded as e:
+                failed[stats] = e
+        for obj, waiters in zip(objs, pending.values()):
+            for fut, stats in waiters:
+                if fut.done():
+                    continue
+                if stats in failed:
+                    fut.set_exception(failed[stats])
+                else:
+                    # 每个调用方得到各自的对象，互不影响
+                    fut.set_result(None if obj is None else self.model.fromRow(obj))
+
+_loaders = {}  # Model => FindLoader
+
+# 定义索引，与Field一起声明在Model中，属性名即索引名：
+#     idx_blog_id_created_at = Index('blog_id', 'created_at')
+# include为覆盖索引额外包含的列(MySQL不支持INCLUDE，追加在索引列之后)
+class Index(object):
+
+    def __init__(self, *columns, unique=False, include=(), name=None):
+        if not columns:
+            raise ValueError('Index requires at least one column.')
+        self.name = name  # 索引名
+        self.columns = tuple(columns)  # 索引列
+        self.unique = unique  # 唯一索引
+        self.include = tuple(include)  # 覆盖索引包含的列
+
+    @property
+    def key_columns(self):
+        return self.columns + tuple(c for c in self.include if c not in self.columns)
+
+    def __str__(self):
+        return '<%s %s:%s>' % (self.__class__.__name__, self.name, ', '.join(self.key_columns))
+
+# 定义紧凑行对象的基类，ModelMetaclass为每个Model生成带__slots__的子类(Model.__row__)
+# 由元组游标直接构造，没有dict的开销，适合只读的大列表，序列化时调用to_dict()
+class Row(object):
+    __slots__ = ()
+
+    def __init__(self, *values, **kw):
+        for k, v in zip(self.__slots__, values):
+            object.__setattr__(self, k, v)
+        for k, v in kw.items():
+            object.__setattr__(self, k, v)
+
+    # 由元组结果集批量构造，columns为结果集的列名
+    @classmethod
+    def fromTuples(cls, columns, rs):
+        if tuple(columns) == cls.__slots__:
+            return cls.__from_tuples__(rs)
+        return [cls(**dict(zip(columns, r))) for r in rs]
+
+    def getCursor(self):
+        return encode_cursor([getattr(self, k, None) for k in self.__model__.__keyset__])
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__ if hasattr(self, k)}
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.to_dict())
+
+# 为Model生成专用的编解码函数，每行只调用一次，省去逐列的getattr、__mappings__查找及callable判断：
+#     __encode__(self)：填充默认值，返回与__insert__参数顺序一致的列表
+#     __decode__(r)：由查询结果(dict)构造对象并开始跟踪修改
+#     __decode_all__(rs)：批量构造
+def make_codecs(model):
+    ns = dict(_get=dict.get, _new=dict.__new__, _update=dict.update, _setattr=object.__setattr__, _model=model)
+    lines = ['def __encode__(self):']
+    names = model.__fields__ + [model.__primary_key__]
+    for i, f in enumerate(names):
+        default = model.__mappings__[f].default
+        lines.append('    v%d = _get(self, %r)' % (i, f))
+        if default is not None:
+            ns['_d%d' % i] = default
+            lines.append('    if v%d is None:' % i)
+            lines.append('        v%d = self[%r] = _d%d%s' % (i, f, i, '()' if callable(default) else ''))
+    lines.append('    return [%s]' % ', '.join('v%d' % i for i in range(len(names))))
+    lines.append('def __decode__(r):')
+    lines.append('    obj = _new(_model)')
+    lines.append('    _update(obj, r)')
+    lines.append("    _setattr(obj, '__dirty__', set())")
+    lines.append('    return obj')
+    lines.append('def __decode_all__(rs):')
+    lines.append('    L = []')
+    lines.append('    for r in rs:')
+    lines.append('        obj = _new(_model)')
+    lines.append('        _update(obj, r)')
+    lines.append("        _setattr(obj, '__dirty__', set())")
+    lines.append('        L.append(obj)')
+    lines.append('    return L')
+    exec('\n'.join(lines), ns)
+    return ns['__encode__'], ns['__decode__'], ns['__decode_all__']
+
+# 为紧凑行对象类生成专用函数：
+#     __from_tuples__(rs)：由列顺序与槽位一致的元组结果集批量构造
+#     to_dict(self)：未赋值的槽位不输出
+def make_row_codecs(row):
+    slots = row.__slots__
+    lines = ['def __from_tuples__(rs):', '    L = []', '    for r in rs:', '        obj = _new(_row)']
+    lines.append('        %s = r' % ', '.join('obj.%s' % k for k in slots))
+    lines.append('        L.append(obj)')
+    lines.append('    return L')
+    lines.extend(['def to_dict(self):', '    d = {}'])
+    for k in slots:
+        lines.append('    try:')
+        lines.append('        d[%r] = self.%s' % (k, k))
+        lines.append('    except AttributeError:')
+        lines.append('        pass')
+    lines.append('    return d')
+    ns = dict(_new=object.__new__, _row=row)
+    exec('\n'.join(lines), ns)
+    return ns['__from_tuples__'], ns['to_dict']
 
 # 定义metaclass元类
 class ModelMetaclass(type):
@@ -137,6 +1565,17 @@ class ModelMetaclass(type):
         # 必须设置主键
         if not primaryKey:
             raise RuntimeError('Primary key not found.')
+        # 获取所有的Index
+        indexes = []
+        for k, v in list(attrs.items()):
+            if isinstance(v, Index):
+                v.name = v.name or k
+                for c in v.key_columns:
+                    if c not in mappings:
+                        raise RuntimeError('Index %s refers to unknown field: %s' % (v.name, c))
+                logging.info('  found index: %s' % v)
+                indexes.append(v)
+                attrs.pop(k)
         # 从类属性中删除Field属性，否则容易造成运行时错误（实例的属性会遮盖类的同名属性）
         for k in mappings.keys():
             attrs.pop(k)
@@ -145,31 +1584,114 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName  # 保存表名
         attrs['__primary_key__'] = primaryKey  # 保存主键属性名
         attrs['__fields__'] = fields # 保存除主键外的属性名
+        attrs['__deferred__'] = [f for f in fields if mappings[f].deferred]  # 保存延迟加载的属性名
+        attrs['__indexes__'] = indexes  # 保存索引
+        # 键集分页使用的列，默认为(created_at, 主键)
+        attrs['__keyset__'] = attrs.get('__keyset__', None) or (('created_at', primaryKey) if 'created_at' in mappings else (primaryKey,))
         # 构造默认的SELECT、INSERT、UPDATE和DELETE语句
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__updates__'] = {}  # 缓存只更新部分列的UPDATE语句：(列名,...) => SQL
+        model = type.__new__(cls, name, bases, attrs)
+        # 生成紧凑行对象类，槽位顺序与__select__的列顺序一致
+        model.__row__ = type('%sRow' % name, (Row,), dict(__slots__=tuple([primaryKey] + fields), __model__=model))
+        # 生成编解码函数
+        from_tuples, to_dict = make_row_codecs(model.__row__)
+        model.__row__.__from_tuples__ = staticmethod(from_tuples)
+        model.__row__.to_dict = to_dict
+        encode, decode, decode_all = make_codecs(model)
+        model.__encode__ = encode
+        model.__decode__ = staticmethod(decode)
+        model.__decode_all__ = staticmethod(decode_all)
+        return model
 
 # 定义所有ORM映射的基类Model
 class Model(dict, metaclass=ModelMetaclass):
 
+    __batch_find__ = False  # 是否合并同一轮事件循环中的find(pk)
+    __dirty__ = None  # 从数据库读取的对象记录自读取后修改过的列，None表示未跟踪(新建的对象)
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+
+    # 由查询结果构造对象，开始跟踪修改过的列
+    @classmethod
+    def fromRow(cls, r):
+        return cls.__decode__(r)
     
     def __getattr__(self, key):
         try:
             return self[key]
         except KeyError:
+            if key in self.__mappings__:
+                raise AttributeError(r"'Model' object has no attribute '%s' (not loaded, call load() first)" % key)
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
     
     def __setattr__(self, key, value):
         self[key] = value
+
+    def __setitem__(self, key, value):
+        # 值未变化的赋值不算修改
+        if self.__dirty__ is not None and key in self.__mappings__ and (key not in self or self[key] != value):
+            self.__dirty__.add(key)
+        super(Model, self).__setitem__(key, value)
+
+    # 获取自读取后修改过的列，未跟踪的对象返回None
+    def getDirty(self):
+        if self.__dirty__ is None:
+            return None
+        return [f for f in self.__fields__ if f in self.__dirty__]
+
+    # 构造只更新指定列的UPDATE语句，按列组合缓存
+    @classmethod
+    def getUpdate(cls, fields):
+        fields = tuple(fields)
+        sql = cls.__updates__.get(fields, None)
+        if sql is None:
+            sql = cls.__updates__[fields] = 'update `%s` set %s where `%s`=?' % (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__)
+        return sql
     
     def getValue(self, key):
         return getattr(self, key, None)
     
+    # 构造只查询部分列的SELECT语句，主键总是被查询
+    # total=True时只查询主键__id__及窗口函数count(*) over ()统计的总行数__total__，用于findPage的派生表
+    @classmethod
+    def getSelect(cls, fields=None, defer=False, total=False):
+        if total:
+            return 'select `%s` `__id__`, count(*) over () `__total__` from `%s`' % (cls.__primary_key__, cls.__table__)
+        if fields is None and not defer:
+            return cls.__select__
+        return 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, cls.getColumns(fields, defer))), cls.__table__)
+
+    # 获取查询的列名，主键在最前
+    @classmethod
+    def getColumns(cls, fields=None, defer=False):
+        if fields is None:
+            fields = cls.__fields__
+        for f in fields:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field: %s' % f)
+        return [cls.__primary_key__] + [f for f in cls.__fields__ if f in fields and not (defer and f in cls.__deferred__)]
+
+    # 加载未读取的列(默认为全部未读取的列)，用于延迟加载的TextField
+    async def load(self, *fields):
+        if not fields:
+            fields = [f for f in self.__fields__ if f not in self]
+        if not fields:
+            return self
+        rs = await select('%s where `%s`=?' % (self.getSelect(fields), self.__primary_key__), [self.getValue(self.__primary_key__)], 1)
+        if len(rs) == 0:
+            raise ValueError('Record not found: %s' % self.getValue(self.__primary_key__))
+        dict.update(self, rs[0])
+        return self
+
+    # 根据键集的值生成本记录的分页游标
+    def getCursor(self):
+        return encode_cursor([self.getValue(k) for k in self.__keyset__])
+
     def getValueOrDefault(self, key):
         value = getattr(self, key, None)
         if value is None:
@@ -184,13 +1706,49 @@ class Model(dict, metaclass=ModelMetaclass):
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause'
-        sql = [cls.__select__]
+        sql, args = cls.buildSelect(where, args, **kw)
+        # compact=True时返回只读的紧凑行对象(Model.__row__)
+        if kw.get('compact', False):
+            rs = await select(sql, args, as_tuple=True)
+            return cls.__row__.fromTuples(cls.getColumns(kw.get('fields', None), kw.get('defer', False)), rs)
+        rs = await select(sql, args)
+        return cls.__decode_all__(rs)
+
+    # 流式遍历WHERE条件查找的结果，每次从服务端游标读取batch行，内存占用有上限
+    @classmethod
+    async def iter_all(cls, where=None, args=None, batch=1000, **kw):
+        ' iterate objects by where clause: async for obj in Model.iter_all(...)'
+        sql, args = cls.buildSelect(where, args, **kw)
+        if kw.get('compact', False):
+            columns = cls.getColumns(kw.get('fields', None), kw.get('defer', False))
+            async for r in stream(sql, args, batch, as_tuple=True):
+                yield cls.__row__.fromTuples(columns, [r])[0]
+            return
+        async for r in stream(sql, args, batch):
+            yield cls.fromRow(r)
+
+    # 构造findAll的SELECT语句及参数
+    @classmethod
+    def buildSelect(cls, where=None, args=None, **kw):
+        # fields指定只查询的列，defer=True时不查询延迟加载的列(如TextField)
+        sql = [cls.getSelect(kw.get('fields', None), kw.get('defer', False), kw.get('total', False))]
+        args = list(args) if args else []  # 复制一份再追加LIMIT等参数，不修改调用方的列表
+        orderBy = kw.get('orderBy', None)
+        # 键集分页：传入after(游标，None表示第一页)时按__keyset__倒序，从游标之后开始取，不再使用offset
+        if 'after' in kw:
+            if orderBy or isinstance(kw.get('limit', None), tuple):
+                raise ValueError('Keyset pagination does not accept orderBy or offset.')
+            if kw['after']:
+                values = decode_cursor(kw['after'])
+                if len(values) != len(cls.__keyset__):
+                    raise ValueError('Invalid cursor: %s' % kw['after'])
+                keysetWhere, keysetArgs = create_keyset_where(cls.__keyset__, values)
+                where = '(%s) and (%s)' % (where, keysetWhere) if where else keysetWhere
+                args = list(args) + keysetArgs
+            orderBy = ', '.join(map(lambda k: '`%s` desc' % k, cls.__keyset__))
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
@@ -205,50 +1763,411 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        return ' '.join(sql), args
     
+    # 分页查找，返回(Page, 本页对象列表)，在同一个连接上完成：
+    # 支持窗口函数且未开启行数缓存时，一条语句同时返回本页的行及总行数(approximate只对行数缓存有效，此时忽略)：
+    # 派生表中只用主键统计总行数并取出本页的主键，再关联回表读取本页的列，不必为统计读取所有行的全部列；
+    # 否则先统计行数(可由行数缓存或approximate估算值返回)，行数为0或页码超出范围时不再查询
+    # 其余参数同findAll：fields、defer、compact
+    @classmethod
+    async def findPage(cls, where=None, args=None, orderBy=None, page_index=1, page_size=10, approximate=False, **kw):
+        ' find one page of objects with the total count'
+        compact = kw.get('compact', False)
+        async with pinned():
+            if get_backend().window_count and get_count_cache() is None:
+                page, sqlArgs = cls.buildSelect(where, args, orderBy=orderBy, limit=((page_index - 1) * page_size, page_size), total=True)
+                sql = 'select %s, `__page__`.`__total__` from `%s` join (%s) `__page__` on `%s`.`%s`=`__page__`.`__id__`' % (', '.join(map(lambda f: '`%s`' % f, cls.getColumns(kw.get('fields', None), kw.get('defer', False)))), cls.__table__, page, cls.__table__, cls.__primary_key__)
+                if orderBy:
+                    sql = '%s order by %s' % (sql, orderBy)
+                rs = await select(sql, sqlArgs, as_tuple=compact)
+                if rs or page_index == 1:
+                    num = (rs[0][-1] if compact else rs[0]['__total__']) if rs else 0
+                    if compact:
+                        return Page(num, page_index, page_size), cls.__row__.fromTuples(cls.getColumns(kw.get('fields', None), kw.get('defer', False)), [r[:-1] for r in rs])
+                    objs = cls.__decode_all__(rs)
+                    for obj in objs:
+                        dict.pop(obj, '__total__')
+                    return Page(num, page_index, page_size), objs
+            num = await cls.findNumber('count(*)', where, args, approximate=approximate)
+            p = Page(num, page_index, page_size)
+            if p.limit == 0:
+                return p, []
+            return p, await cls.findAll(where, args, orderBy=orderBy, limit=(p.offset, p.limit), **kw)
+
     # 根据WHERE条件查找，但返回的是整数，适用于select count(*)类型的SQL
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, approximate=False):
         ' find number by select and where'
+        # 开启行数缓存时先查缓存；approximate=True时大表的行数使用information_schema中的估算值
+        countCache = get_count_cache() if not in_transaction() else None
+        key = None
+        if countCache is not None:
+            key = (cls.__table__.lower(), selectField, where or None, tuple(args or ()))
+            num = countCache.get(key)
+            if num is not None:
+                return num
+            generation = countCache.generation
+            if approximate and not where and _RE_ROW_COUNT.match(selectField.strip()) and get_backend().approximate_rows_sql:
+                rs = await select(get_backend().approximate_rows_sql, [cls.__table__], 1, cache=False)
+                if len(rs) > 0 and rs[0]['__num__'] is not None and rs[0]['__num__'] >= countCache.approximate_threshold:
+                    countCache.put(key, rs[0]['__num__'], generation)
+                    return rs[0]['__num__']
         sql = ['select %s __num__ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1, cache=key is None)
         if len(rs) == 0:
             return None
+        if key is not None:
+            countCache.put(key, rs[0]['__num__'], generation)
         return rs[0]['__num__']
     
     # 根据主键查找
     @classmethod
-    async def find(cls, pk):
+    async def find(cls, pk, fields=None):
         ' find object by primary key'
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        # 设置了__batch_find__的Model，同一轮事件循环中的find合并为一次查询；
+        # 事务或固定连接中、设置了截止时间、指定了列或需要读自己的写入时不合并
+        if cls.__batch_find__ and fields is None and not in_transaction() and _pinned.get() is None and _deadline.get() is None and not _read_your_writes.get():
+            loader = _loaders.get(cls, None)
+            if loader is None:
+                loader = _loaders[cls] = FindLoader(cls)
+            return await loader.load(pk)
+        rs = await select('%s where `%s`=?' % (cls.getSelect(fields), cls.__primary_key__), [pk], 1)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls.fromRow(rs[0])
     
+    # 根据主键列表查找，返回与pks顺序一致的列表，不存在的主键对应None
+    @classmethod
+    async def find_many(cls, pks, fields=None, chunk_size=500):
+        ' find objects by primary keys'
+        pks = list(pks)
+        found = {}
+        for chunk in chunks(list(collections.OrderedDict.fromkeys(pks)), chunk_size):
+            rs = await select('%s where `%s` in (%s)' % (cls.getSelect(fields), cls.__primary_key__, create_args_string(len(chunk))), chunk)
+            for r in rs:
+                found[r[cls.__primary_key__]] = r
+        return [cls.fromRow(found[pk]) if pk in found else None for pk in pks]
+
     # 保存属性(INSERT操作)
     async def save(self):
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
+        args = self.__encode__()
         rows = await execute(self.__insert__, args)
+        adjust_count(self.__table__, rows)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
+        else:
+            self.__dict__['__dirty__'] = set()
     
     # 更新属性(UPDATE操作)
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        # 从数据库读取的对象只更新修改过的列，没有修改时不执行UPDATE；
+        # 新建的对象先加载未赋值的列再更新全部列，避免将其更新为NULL
+        fields = self.getDirty()
+        if fields is None:
+            await self.load()
+            fields = self.__fields__
+        elif not fields:
+            return
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(self.getUpdate(fields), args)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        else:
+            self.__dict__['__dirty__'] = set()
     
+    # 批量保存(多行VALUES的INSERT操作)，每批最多chunk_size行
+    @classmethod
+    async def save_many(cls, objs, chunk_size=500):
+        rows = 0
+        for chunk in chunks(list(objs), chunk_size):
+            values = ', (%s)' % create_args_string(len(cls.__fields__) + 1)
+            args = []
+            for obj in chunk:
+                args.extend(obj.__encode__())
+            affected = await execute(cls.__insert__ + values * (len(chunk) - 1), args)
+            adjust_count(cls.__table__, affected)
+            rows += affected
+            # 与save()一样，插入后开始跟踪修改过的列
+            for obj in chunk:
+                obj.__dict__['__dirty__'] = set()
+        return rows
+
+    # 批量更新(executemany执行UPDATE操作)，按修改过的列分组，每组一条UPDATE语句
+    @classmethod
+    async def update_many(cls, objs, chunk_size=500):
+        objs = list(objs)
+        # 未跟踪的对象每批用一条IN查询加载未读取的列，避免逐个load()
+        for chunk in chunks([obj for obj in objs if obj.getDirty() is None], chunk_size):
+            await cls._load_many(chunk)
+        groups = collections.OrderedDict()
+        for obj in objs:
+            fields = obj.getDirty()
+            if fields is None:
+                fields = cls.__fields__
+            if fields:
+                groups.setdefault(tuple(fields), []).append(obj)
+        rows = 0
+        for fields, group in groups.items():
+            for chunk in chunks(group, chunk_size):
+                args = [list(map(obj.getValue, fields)) + [obj.getValue(cls.__primary_key__)] for obj in chunk]
+                rows += await executemany(cls.getUpdate(fields), args)
+                for obj in chunk:
+                    obj.__dict__['__dirty__'] = set()
+        return rows
+
+    # 为一批对象加载未读取的列(取各对象缺少的列的并集)，已有的值不被覆盖
+    @classmethod
+    async def _load_many(cls, objs):
+        fields = [f for f in cls.__fields__ if any(f not in obj for obj in objs)]
+        if not fields:
+            return
+        pks = [obj.getValue(cls.__primary_key__) for obj in objs]
+        rs = await select('%s where `%s` in (%s)' % (cls.getSelect(fields), cls.__primary_key__, create_args_string(len(pks))), pks)
+        found = {r[cls.__primary_key__]: r for r in rs}
+        for obj, pk in zip(objs, pks):
+            if pk not in found:
+                raise ValueError('Record not found: %s' % pk)
+            for k, v in found[pk].items():
+                if k not in obj:
+                    dict.__setitem__(obj, k, v)
+
+    # 批量移除(按主键IN列表执行DELETE操作)
+    @classmethod
+    async def remove_many(cls, objs, chunk_size=500):
+        rows = 0
+        for chunk in chunks(list(objs), chunk_size):
+            args = [obj.getValue(cls.__primary_key__) for obj in chunk]
+            affected = await execute('delete from `%s` where `%s` in (%s)' % (cls.__table__, cls.__primary_key__, create_args_string(len(args))), args)
+            adjust_count(cls.__table__, -affected)
+            rows += affected
+        return rows
+
     # 移除属性(DELETE操作)
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        adjust_count(self.__table__, -rows)
         if rows != 1:
-            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
\ No newline at end of file
+            logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+
+# 定义计数列的缓冲写入器：计数的增量先在内存中按主键合并，每interval秒在一个事务中批量写入；
+# reconcile()按source表中key列的行数校正计数，如：
+#     CounterBuffer(Blog, 'comment_count', Comment, 'blog_id')
+# 计数最多落后interval秒，进程退出时未写入的增量由下次校正补齐
+class CounterBuffer(object):
+
+    def __init__(self, model, field, source, key):
+        self.model = model
+        self.field = field
+        self.source = source
+        self.key = key
+        self._pending = {}  # 主键 => 未写入的增量
+
+    @property
+    def pending(self):
+        return dict(self._pending)
+
+    def add(self, pk, delta=1):
+        self._pending[pk] = self._pending.get(pk, 0) + delta
+
+    # 写入合并后的增量，返回更新的行数；失败时增量放回，下次重试
+    async def flush(self):
+        pending = self._pending
+        self._pending = {}
+        args = [(delta, pk) for pk, delta in pending.items() if delta]
+        if not args:
+            return 0
+        sql = 'update `%s` set `%s`=`%s`+? where `%s`=?' % (self.model.__table__, self.field, self.field, self.model.__primary_key__)
+        try:
+            return await executemany(sql, args, autocommit=False)
+        except BaseException:
+            for pk, delta in pending.items():
+                self.add(pk, delta)
+            raise
+
+    # 按主键分批校正计数，返回校正的行数。每批先写入缓冲的增量再统计，
+    # 统计后又有增量的行留到下次校正；更新时比较旧值，期间被增量修改过的行不覆盖
+    async def reconcile(self, batch=500):
+        pk = self.model.__primary_key__
+        fixed = 0
+        last = None
+        while True:
+            await self.flush()
+            where = ' where `%s`>?' % pk if last is not None else ''
+            rs = await select('select `%s` __pk__, `%s` __num__ from `%s`%s order by `%s` limit ?' % (pk, self.field, self.model.__table__, where, pk), ([last] if last is not None else []) + [batch], primary=True, cache=False)
+            if not rs:
+                break
+            last = rs[-1]['__pk__']
+            pks = [r['__pk__'] for r in rs]
+            counts = {r['__key__']: r['__num__'] for r in await select('select `%s` __key__, count(*) __num__ from `%s` where `%s` in (%s) group by `%s`' % (self.key, self.source.__table__, self.key, create_args_string(len(pks)), self.key), pks, primary=True, cache=False)}
+            for r in rs:
+                num = counts.get(r['__pk__'], 0)
+                if r['__num__'] != num and r['__pk__'] not in self._pending:
+                    fixed += await execute('update `%s` set `%s`=? where `%s`=? and `%s`=?' % (self.model.__table__, self.field, pk, self.field), [num, r['__pk__'], r['__num__']])
+        if fixed:
+            logging.info('reconciled %s.%s: %s rows' % (self.model.__table__, self.field, fixed))
+        return fixed
+
+    # 启动后台任务：每interval秒写入增量；启动后先校正一次，之后每reconcile秒校正一次(为None时不校正)，
+    # 补齐上次退出时未写入的增量及新增计数列后已有行的计数
+    def start(self, interval=1, reconcile=3600):
+        return asyncio.ensure_future(self._run(interval, reconcile))
+
+    async def _run(self, interval, reconcile):
+        last = None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+                if reconcile is not None and (last is None or time.monotonic() - last >= reconcile):
+                    last = time.monotonic()
+                    await self.reconcile()
+            except Exception as e:
+                logging.exception(e)
+
+# 定义后写队列：put()的对象先填充默认值(生成主键)并追加到本地的溢出文件，立即返回，
+# 由后台任务每interval秒或积累batch个对象时以多行INSERT写入数据库；队列满maxsize个时put()等待写入。
+# 进程崩溃后start()从溢出文件重放未写入的对象，使用INSERT IGNORE，已写入的行不会重复；正常退出时由close()写入。
+# 溢出文件在单独的线程中写入，不阻塞事件循环；fsync=True时每次put()都等待同步到磁盘(通常每次数毫秒)，
+# 可在系统崩溃时不丢失，但put()更慢。
+# counters为以model为source的CounterBuffer列表，对象写入数据库后才增加计数，校正时不会漏掉尚在队列中的对象
+class WriteBehindQueue(object):
+
+    def __init__(self, model, maxsize=10000, interval=0.05, batch=500, spill=None, fsync=False, counters=()):
+        self.model = model
+        self.maxsize = maxsize
+        self.interval = interval
+        self.batch = batch
+        self.spill = spill
+        self.fsync = fsync
+        self.counters = list(counters)
+        self.flushed = 0  # 已写入的行数
+        self._queue = collections.deque()
+        self._file = None
+        self._writer = None  # 写溢出文件的线程，只有一个线程，写入按提交的顺序进行
+        self._event = None
+        self._lock = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    # 重放溢出文件并启动后台写入任务
+    async def start(self):
+        self._event = asyncio.Event()
+        self._lock = asyncio.Lock()
+        if self.spill and os.path.exists(self.spill):
+            with open(self.spill, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._queue.append(self.model(**json.loads(line)))
+                    except ValueError:
+                        logging.warning('skip broken line in %s' % self.spill)  # 崩溃时写了一半的行
+            if self._queue:
+                logging.warning('replay %s rows from %s' % (len(self._queue), self.spill))
+        if self.spill:
+            self._writer = concurrent.futures.ThreadPoolExecutor(1)
+            self._rewrite(self._lines())
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    # 停止后台任务，写入队列中剩余的对象并关闭溢出文件
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._writer is not None:
+            await asyncio.get_event_loop().run_in_executor(self._writer, self._file.close)
+            self._writer.shutdown()
+            self._writer = None
+
+    async def put(self, obj):
+        while len(self._queue) >= self.maxsize:
+            await self.flush()
+        line = self._dumps(obj)
+        # 先入队再提交写入，与flush()中重写溢出文件的先后顺序无关，对象都会留在溢出文件中
+        self._queue.append(obj)
+        if len(self._queue) >= self.batch:
+            self._event.set()
+        if self._writer is not None:
+            await asyncio.get_event_loop().run_in_executor(self._writer, self._append, line)
+        return obj
+
+    # 写入队列中的全部对象，返回写入的行数
+    async def flush(self):
+        rows = 0
+        async with self._lock:
+            while self._queue:
+                chunk = list(itertools.islice(self._queue, self.batch))
+                rows = rows + await self.insert(chunk)
+                for i in range(len(chunk)):
+                    self._queue.popleft()
+                if self._writer is not None:
+                    await asyncio.get_event_loop().run_in_executor(self._writer, self._rewrite, self._lines())
+        return rows
+
+    # 以多行INSERT IGNORE写入一批对象
+    async def insert(self, objs):
+        model = self.model
+        values = ', (%s)' % create_args_string(len(model.__fields__) + 1)
+        args = []
+        for obj in objs:
+            args.extend(obj.__encode__())
+        sql = get_backend().insert_ignore + model.__insert__[len('insert'):] + values * (len(objs) - 1)
+        rows = await execute(sql, args)
+        adjust_count(model.__table__, rows)
+        self.flushed = self.flushed + rows
+        # 被忽略的行已由之前的写入插入，同样开始跟踪修改过的列
+        for obj in objs:
+            obj.__dict__['__dirty__'] = set()
+        # 有被忽略的行(重放)时无法区分哪些是新写入的，计数留给校正
+        if rows == len(objs):
+            for counter in self.counters:
+                for obj in objs:
+                    counter.add(obj[counter.key])
+        return rows
+
+    # 溢出文件的一行，同时填充对象的默认值(生成主键)
+    def _dumps(self, obj):
+        return json.dumps(dict(zip(self.model.__fields__ + [self.model.__primary_key__], obj.__encode__())), ensure_ascii=False) + '\n'
+
+    # 队列中对象的溢出文件行，在事件循环中生成，避免写文件的线程遍历队列时队列被修改
+    def _lines(self):
+        return [self._dumps(obj) for obj in self._queue]
+
+    # 以下两个方法在写溢出文件的线程中执行
+    def _append(self, line):
+        self._file.write(line)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    # 溢出文件只保留队列中尚未写入的对象
+    def _rewrite(self, lines):
+        if self._file is not None:
+            self._file.close()
+        tmp = '%s.tmp' % self.spill
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp, self.spill)
+        self._file = open(self.spill, 'a', encoding='utf-8')
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._event.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.exception(e)
+                await asyncio.sleep(self.interval)  # 数据库不可用时稍后重试，对象仍在队列及溢出文件中
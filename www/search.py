@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+In-memory full-text search over blogs.
+'''
+
+__author__ = 'ZcJ'
+
+import asyncio, os, re, json, math, heapq, logging, collections
+
+from models import Blog
+
+# 匹配英文单词/数字，以及连续的中日韩文字
+_RE_TOKENS = re.compile(r'[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+')
+
+# 分词：英文按单词，中日韩文字按相邻两字(bigram)切分，单个字保留原样
+def tokenize(text):
+    '''
+    >>> list(tokenize('Hello, Python3 异步编程'))
+    ['hello', 'python3', '异步', '步编', '编程']
+    '''
+    for m in _RE_TOKENS.finditer((text or '').lower()):
+        w = m.group()
+        if w[0] < '\u0080' or len(w) == 1:
+            yield w
+        else:
+            for i in range(len(w) - 1):
+                yield w[i:i + 2]
+
+# 定义倒排索引，按BM25排序
+# 只维护本进程内的索引，多进程部署时各进程只能看到自己处理的修改，需定期重启或重建
+class SearchIndex(object):
+
+    FIELDS = dict(name=3, summary=2, content=1)  # 索引的列及其词频权重
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self._postings = collections.defaultdict(dict)  # 词 => {日志ID: 词频}
+        self._docs = {}  # 日志ID => {词: 词频}，删除或更新时用于清理倒排表
+        self._lengths = {}  # 日志ID => 文档长度
+        self._total = 0  # 所有文档长度之和
+        self.dirty = False  # 上次保存快照后是否有修改
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, id):
+        return id in self._docs
+
+    # 添加或更新一篇日志，blog为Blog对象或包含name、summary、content的dict
+    def add(self, blog):
+        terms = collections.Counter()
+        for field, weight in self.FIELDS.items():
+            for t in tokenize(blog.get(field, None)):
+                terms[t] += weight
+        self._put(blog['id'], dict(terms))
+
+    def remove(self, id):
+        terms = self._docs.pop(id, None)
+        if terms is None:
+            return
+        for t in terms:
+            postings = self._postings[t]
+            postings.pop(id, None)
+            if not postings:
+                del self._postings[t]
+        self._total = self._total - self._lengths.pop(id)
+        self.dirty = True
+
+    def _put(self, id, terms):
+        self.remove(id)
+        self._docs[id] = terms
+        for t, tf in terms.items():
+            self._postings[t][id] = tf
+        self._lengths[id] = sum(terms.values())
+        self._total = self._total + self._lengths[id]
+        self.dirty = True
+
+    # 按BM25得分倒序返回(匹配总数, [(日志ID, 得分), ...])，得分相同时新的日志(ID较大)在前
+    def search(self, query, limit=10, offset=0):
+        if not self._docs:
+            return 0, []
+        n = len(self._docs)
+        avgdl = self._total / n
+        scores = collections.defaultdict(float)
+        for t in set(tokenize(query)):
+            postings = self._postings.get(t, None)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id, tf in postings.items():
+                dl = self._lengths[id]
+                scores[id] += idf * tf * (self.K1 + 1) / (tf + self.K1 * (1 - self.B + self.B * dl / avgdl))
+        ranked = heapq.nlargest(offset + limit, scores.items(), key=lambda x: (x[1], x[0]))
+        return len(scores), ranked[offset:]
+
+    # 序列化快照：只保存正排表，加载时重建倒排表，省去读取全表及分词的开销
+    def dumps(self):
+        self.dirty = False
+        return json.dumps(dict(version=1, fields=self.FIELDS, docs=self._docs), ensure_ascii=False, separators=(',', ':'))
+
+    def save(self, path):
+        write_snapshot(path, self.dumps())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version', None) != 1 or data.get('fields', None) != cls.FIELDS:
+            raise ValueError('Incompatible search snapshot: %s' % path)
+        index = cls()
+        for id, terms in data['docs'].items():
+            index._put(id, terms)
+        index.dirty = False
+        return index
+
+# 先写临时文件再替换，避免写入中途退出留下不完整的快照
+def write_snapshot(path, data):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+__index = None
+__snapshot = None  # 快照文件路径
+__changed = None  # 索引修改后置位的asyncio.Event，通知保存快照
+
+def get_index():
+    return __index
+
+# 启动时创建索引：有快照时加载快照，并按blogs表的ID补充新增、删除已不存在的日志；
+# 没有快照时流式读取blogs表重建。之后每批修改在interval秒后保存快照，退出时由close_search()保存，
+# 快照最多落后interval秒，加载时不会留下已修改日志的旧内容
+async def init_search(snapshot=None, interval=1):
+    global __index, __snapshot, __changed
+    loop = asyncio.get_event_loop()
+    index = None
+    if snapshot and os.path.exists(snapshot):
+        try:
+            index = await loop.run_in_executor(None, SearchIndex.load, snapshot)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning('rebuild search index: %s' % e)
+    if index is None:
+        index = SearchIndex()
+        async for blog in Blog.iter_all():
+            index.add(blog)
+    else:
+        ids = set()
+        async for blog in Blog.iter_all(fields=[]):
+            ids.add(blog.id)
+        for id in set(index._docs) - ids:
+            index.remove(id)
+        missing = [id for id in ids if id not in index]
+        for blog in await Blog.find_many(missing):
+            if blog is not None:
+                index.add(blog)
+    logging.info('search index ready: %s blogs' % len(index))
+    __index = index
+    __snapshot = snapshot
+    if snapshot:
+        __changed = asyncio.Event()
+        if index.dirty:
+            __changed.set()
+        asyncio.ensure_future(_save_on_change(index, snapshot, interval, __changed))
+    return index
+
+# 索引修改后等待interval秒，将期间的修改合并为一次保存；保存在同一个任务中依次进行，不会并发写文件
+async def _save_on_change(index, snapshot, interval, changed):
+    loop = asyncio.get_event_loop()
+    while __index is index:
+        await changed.wait()
+        await asyncio.sleep(interval)
+        changed.clear()
+        if index.dirty:
+            # 在事件循环中序列化，避免与索引的修改并发；只在线程池中写文件
+            try:
+                await loop.run_in_executor(None, write_snapshot, snapshot, index.dumps())
+            except OSError as e:
+                index.dirty = True
+                logging.exception(e)
+
+# 退出前保存未写入快照的修改
+def close_search():
+    if __index is not None and __snapshot and __index.dirty:
+        __index.save(__snapshot)
+        logging.info('search snapshot saved: %s' % __snapshot)
+
+# 在日志创建、修改后更新索引
+def index_blog(blog):
+    if __index is not None:
+        __index.add(blog)
+        if __changed is not None:
+            __changed.set()
+
+# 在日志删除后更新索引
+def remove_blog(id):
+    if __index is not None:
+        __index.remove(id)
+        if __changed is not None:
+            __changed.set()
@@ -0,0 +1,193 @@
+import orm
+import asyncio
+
+# 连接池的测试，使用不连接数据库的假连接：python3 testPool.py
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+class FakeReader(object):
+
+    def __init__(self):
+        self.eof = False
+        self.eof_received = False
+
+    def at_eof(self):
+        return self.eof
+
+    def exception(self):
+        return None
+
+class FakeMySQLConnection(FakeConnection):
+
+    def __init__(self):
+        super().__init__()
+        self._reader = FakeReader()
+
+    def get_transaction_status(self):
+        return self.in_transaction
+
+def make_pool(conn_class=FakeConnection, pool_class=orm.Pool, fail=None, **kw):
+    opened = []
+    async def connect():
+        await asyncio.sleep(0)
+        if fail is not None and fail[0]:
+            fail[0] = fail[0] - 1
+            raise ConnectionError('connect failed')
+        conn = conn_class()
+        opened.append(conn)
+        return conn
+    return pool_class(connect, **kw), opened
+
+async def test_acquire_release():
+    pool, opened = make_pool(minsize=1, maxsize=2, warmup=2)
+    await pool.fill()
+    assert pool.size == 2 and pool.freesize == 2
+    c1 = await pool.acquire()
+    c2 = await pool.acquire()
+    assert c1 is not c2 and pool.freesize == 0
+    pool.release(c1)
+    # 优先取出最近归还的连接
+    assert await pool.acquire() is c1
+    pool.release(c1)
+    pool.release(c2)
+    assert pool.size == 2 and len(opened) == 2
+
+async def test_handoff():
+    pool, opened = make_pool(maxsize=1)
+    c1 = await pool.acquire()
+    waiter = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    assert len(pool._waiters) == 1
+    pool.release(c1)
+    # 归还的连接直接交给等待者，不经过空闲队列
+    assert await waiter is c1 and pool.freesize == 0 and c1 in pool._used
+    pool.release(c1)
+    assert pool.freesize == 1
+
+async def test_cancel_waiting():
+    pool, opened = make_pool(maxsize=1)
+    c1 = await pool.acquire()
+    waiter = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    pool.release(c1)
+    assert pool.freesize == 1 and not pool._used
+
+async def test_cancel_after_handoff():
+    # 连接已交给等待者、等待者尚未运行就被取消：连接应归还连接池，而不是丢失
+    pool, opened = make_pool(maxsize=1)
+    c1 = await pool.acquire()
+    waiter = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    pool.release(c1)
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert waiter.cancelled()
+    assert pool.freesize == 1 and not pool._used and pool.size == 1
+    assert await pool.acquire() is c1
+
+async def test_cancel_after_wakeup():
+    # 等待者被唤醒去打开新连接前被取消：唤醒传给下一个等待者
+    pool, opened = make_pool(maxsize=1)
+    c1 = await pool.acquire()
+    w1 = asyncio.ensure_future(pool.acquire())
+    w2 = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    c1.close()
+    pool.release(c1)
+    w1.cancel()
+    await asyncio.gather(w1, return_exceptions=True)
+    c2 = await asyncio.wait_for(w2, 1)
+    assert c2 is not c1 and pool.size == 1
+
+async def test_open_failure():
+    # 打开连接失败时唤醒下一个等待者重试
+    fail = [0]
+    pool, opened = make_pool(maxsize=1, fail=fail)
+    c1 = await pool.acquire()
+    w1 = asyncio.ensure_future(pool.acquire())
+    w2 = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    fail[0] = 1
+    c1.close()
+    pool.release(c1)
+    results = await asyncio.wait_for(asyncio.gather(w1, w2, return_exceptions=True), 1)
+    assert isinstance(results[0], ConnectionError)
+    assert isinstance(results[1], FakeConnection) and pool.size == 1
+
+async def test_release_in_transaction():
+    pool, opened = make_pool(maxsize=2)
+    c1 = await pool.acquire()
+    c1.in_transaction = True
+    pool.release(c1)
+    assert c1.closed and pool.size == 0 and c1 not in pool
+
+async def test_limit_growth_and_shrink():
+    pool, opened = make_pool(minsize=1, maxsize=8, limit=2, target_wait=0.001, interval=60)
+    conns = [await pool.acquire() for i in range(2)]
+    waiter = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0.01)
+    pool.release(conns.pop())
+    conns.append(await waiter)
+    # 统计周期结束时平均等待时间超过target_wait，上限调高
+    pool._window_start = pool._window_start - 60
+    conns.append(await pool.acquire())
+    assert pool.limit == 3 and pool.size == 3
+    for conn in conns:
+        pool.release(conn)
+    assert pool.freesize == 3
+    # 下一个周期内没有使用连接：上限调回，空闲连接逐步关闭到minsize
+    pool._peak = 0
+    pool._window_start = pool._window_start - 60
+    pool._adjust(pool._window_start + 60)
+    assert pool.limit == 2 and pool.size == 2
+    pool._window_start = pool._window_start - 60
+    pool._adjust(pool._window_start + 60)
+    assert pool.size == 1
+    pool._window_start = pool._window_start - 60
+    pool._adjust(pool._window_start + 60)
+    assert pool.size == 1
+
+async def test_shrink_on_release():
+    # 上限调低后，超出上限的连接在归还时关闭
+    pool, opened = make_pool(maxsize=4)
+    conns = [await pool.acquire() for i in range(4)]
+    pool.limit = 2
+    for conn in conns:
+        pool.release(conn)
+    assert pool.size == 2 and sum(c.closed for c in conns) == 2
+
+async def test_lifetime_recycling():
+    pool, opened = make_pool(maxsize=2, max_lifetime=0.01)
+    c1 = await pool.acquire()
+    pool.release(c1)
+    await asyncio.sleep(0.02)
+    c2 = await pool.acquire()
+    assert c2 is not c1 and c1.closed and c1 not in pool
+    await asyncio.sleep(0.02)
+    pool.release(c2)
+    assert c2.closed and pool.size == 0
+
+async def test_mysql_stale():
+    # 服务端关闭了空闲连接：closed仍为False，但读取流已结束
+    pool, opened = make_pool(FakeMySQLConnection, orm.MySQLPool, maxsize=2, warmup=2)
+    await pool.fill()
+    c1, c2 = list(pool._free)
+    c2._reader.eof = True
+    c1._reader.eof_received = True
+    c3 = await pool.acquire()
+    assert c3 not in (c1, c2) and c1.closed and c2.closed and pool.size == 1
+
+loop = asyncio.get_event_loop()
+for name, fn in list(globals().items()):
+    if name.startswith('test_'):
+        loop.run_until_complete(fn())
+        print('%s ok' % name)
@@ -4,14 +4,27 @@ from models import User, Blog, Comment
 
 loop = asyncio.get_event_loop()
 async def test():
-    await orm.create_pool(user='www-data', password='www-data', db='awesome', loop=loop)
+    # 使用SQLite后端，无需MySQL即可测试；连接MySQL时改为：
+    # await orm.create_pool(user='www-data', password='www-data', db='awesome', loop=loop)
+    await orm.create_pool(backend='sqlite', db=':memory:', loop=loop)
+    await orm.create_tables(User, Blog, Comment)
 
-    # u1 = User(name='ZcJ', email='test1@example.com', passwd='1234567890', image='about:blank')
-    # u2 = User(name='Love', email='test2@example.com', passwd='1234567890', image='about:blank')
-    # u3 = User(name='Rqq', email='test3@example.com', passwd='1234567890', image='about:blank')
+    u1 = User(name='ZcJ', email='test1@example.com', passwd='1234567890', image='about:blank')
+    u2 = User(name='Love', email='test2@example.com', passwd='1234567890', image='about:blank')
+    u3 = User(name='Rqq', email='test3@example.com', passwd='1234567890', image='about:blank')
 
-    # await u1.save()
-    # await u2.save()
-    # await u3.save()
+    await u1.save()
+    await u2.save()
+    await u3.save()
 
-loop.run_until_complete(test())
\ No newline at end of file
+    print(await User.findAll(orderBy='created_at desc'))
+
+    # 分页：带条件的查询及超出范围的页码，调用方的args不应被修改
+    args = [False]
+    p, users = await User.findPage('admin=?', args, orderBy='created_at desc', page_index=1, page_size=2)
+    assert p.item_count == 3 and len(users) == 2 and args == [False]
+    p, users = await User.findPage('admin=?', args, orderBy='created_at desc', page_index=9, page_size=2)
+    assert p.item_count == 3 and users == [] and args == [False]
+    print(p, users)
+
+loop.run_until_complete(test())